@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, jsonify
+
+from flaskr.encoding import StdlibJSONProvider, OrjsonJSONProvider, orjson
+from flaskr.generator import generate_questions
+from flaskr.models import format_question_row
+
+# Compares encoding a questions listing (100k questions by default) with
+# flask's jsonify, each JSON provider and each provider streaming the array.
+# Reports encode time and the peak memory allocated while encoding, starting
+# from the question rows a listing reads from the database.
+#
+#   python benchmarks/json_encoding.py
+#   python benchmarks/json_encoding.py --questions 10000 100000 1000000
+
+
+def question_rows(count, seed):
+    rows = generate_questions(count, {category_id: 1 for category_id in range(1, 7)}, seed=seed)
+    return [
+        (question_id, row['question'], row['answer'], row['difficulty'], row['category_id'], 1)
+        for (question_id, row) in enumerate(rows, 1)
+    ]
+
+
+def listing(questions):
+    return {'success': True, 'total_questions': len(questions), 'next_cursor': None, 'questions': questions}
+
+
+def encoders(app, chunk_size):
+    providers = [StdlibJSONProvider()] + ([OrjsonJSONProvider()] if orjson is not None else [])
+
+    def flask_jsonify(questions):
+        with app.app_context():
+            data = listing([format_question_row(question) for question in questions])
+            return len(jsonify(data).get_data())
+
+    def encode(provider):
+        def run(questions):
+            data = listing([format_question_row(question) for question in questions])
+            return len(provider.dumps(data))
+        return run
+
+    def stream(provider):
+        def run(questions):
+            chunks = provider.stream(listing(questions), 'questions', map(format_question_row, questions), chunk_size)
+            return sum(len(chunk) for chunk in chunks)
+        return run
+
+    yield ('flask_jsonify', flask_jsonify)
+    for provider in providers:
+        yield (provider.name, encode(provider))
+    for provider in providers:
+        yield (f'{provider.name}_streamed', stream(provider))
+
+
+def run(encoder, questions, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = encoder(questions)
+        timings.append(time.perf_counter() - start)
+
+    # peak of one more run, traced separately so tracing doesn't skew the timings
+    tracemalloc.start()
+    encoder(questions)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    return {'encode_ms': timings[len(timings) // 2] * 1000, 'peak_bytes': peak, 'response_bytes': size}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark encoding large question listings')
+    parser.add_argument('--questions', type=int, nargs='+', default=[100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+
+    for count in args.questions:
+        questions = question_rows(count, args.seed)
+        for (name, encoder) in encoders(app, args.chunk_size):
+            print(json.dumps({'questions': count, 'encoder': name, **run(encoder, questions, args.repeat)}))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,69 @@
 import os
-from flask import Flask, request, abort, jsonify
+import time
+from functools import wraps
+from flask import Flask, Response, request, abort, make_response, g, stream_with_context
 from flask_cors import CORS
-from sqlalchemy import func
+import click
+from sqlalchemy import create_engine, func, text
+from sqlalchemy.exc import DBAPIError
 from schema import Schema, And, Use, Optional, SchemaError
-import random
-import re
 
-from .models import db, setup_db, Question, Category
+from .models import db, setup_db, Question, count_questions, recount_questions, category_question_counts, category_question_ids, data_version, \
+    QUESTION_FORMAT_COLUMNS, format_question_row
+from .queries import QUIZ_RANDOM_MODES, CountCache, random_question, encode_cursor, decode_cursor
+from .bulk import BULK_FORMATS, EXPORT_FORMATS, batches, insert_questions, question_schema, read_rows, validate_rows, export_rows, export_questions, \
+    selection_schema, selection_query, update_questions, delete_questions, update_question_row, delete_question_row
+from .budgets import query_budget, check_query_budget
+from .encoding import JSON_PROVIDERS, json_provider, jsonify
+from .generator import parse_weights, generate_questions, write_questions
+from .metrics import Metrics
+from .pool import engine_options, pool_stats
+from .replicas import ReplicaRouter
+from .quiz_sessions import QuizSessionStore
+from .registry import CategoryRegistry
+from .search import SEARCH_BACKENDS, create_search_index, search_questions_query, regex_questions_query, \
+    regex_timeout, regex_timed_out
 
 QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+QUIZ_SESSION_TTL = 3600
+QUIZ_SESSION_MAX = 10000
+QUIZ_SESSION_DECK_SIZE = 100
+QUIZ_SESSION_LOOKAHEAD = 10
+QUIZ_RANDOM_MODE = 'range'
+SEARCH_COUNT_TTL = 60
+SEARCH_BACKEND = 'fulltext'
+SEARCH_REGEX_TIMEOUT = 1000
+CATEGORY_REGISTRY_TTL = 300
+BULK_BATCH_SIZE = 5000
+MAX_BULK_ERRORS = 1000
+EXPORT_CHUNK_SIZE = 1000
+DATABASE_POOL_SIZE = 5
+DATABASE_MAX_OVERFLOW = 10
+DATABASE_POOL_TIMEOUT = 30
+DATABASE_POOL_RECYCLE = -1
+DATABASE_POOL_PRE_PING = False
+DATABASE_STATEMENT_TIMEOUT = 0
+DATABASE_REPLICA_URLS = ()
+DATABASE_REPLICA_RETRY = 30
+METRICS_ENABLED = True
+JSON_PROVIDER = 'auto'
+JSON_STREAM_THRESHOLD = 1000
+JSON_STREAM_CHUNK_SIZE = 500
+
+
+# Reads a setting from the environment, converted to the type of its default
+def from_env(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, tuple):
+        return tuple(item.strip() for item in value.split(',') if item.strip())
+    return value
 
 
 def create_app(test_config=None):
@@ -18,68 +73,395 @@ def create_app(test_config=None):
 
     # Create flask app and setup CORS
     app = Flask(__name__)
+    app.config.from_mapping(
+        QUIZ_SESSION_TTL=QUIZ_SESSION_TTL,
+        QUIZ_SESSION_MAX=QUIZ_SESSION_MAX,
+        QUIZ_SESSION_DECK_SIZE=QUIZ_SESSION_DECK_SIZE,
+        QUIZ_RANDOM_MODE=QUIZ_RANDOM_MODE,
+        SEARCH_COUNT_TTL=SEARCH_COUNT_TTL,
+        SEARCH_BACKEND=SEARCH_BACKEND,
+        SEARCH_REGEX_TIMEOUT=SEARCH_REGEX_TIMEOUT,
+        CATEGORY_REGISTRY_TTL=CATEGORY_REGISTRY_TTL,
+        CATEGORY_REGISTRY_PUBLISH=None,
+        BULK_BATCH_SIZE=BULK_BATCH_SIZE,
+        EXPORT_CHUNK_SIZE=EXPORT_CHUNK_SIZE,
+        DATABASE_URL=from_env('DATABASE_URL', None),
+        DATABASE_POOL_SIZE=from_env('DATABASE_POOL_SIZE', DATABASE_POOL_SIZE),
+        DATABASE_MAX_OVERFLOW=from_env('DATABASE_MAX_OVERFLOW', DATABASE_MAX_OVERFLOW),
+        DATABASE_POOL_TIMEOUT=from_env('DATABASE_POOL_TIMEOUT', DATABASE_POOL_TIMEOUT),
+        DATABASE_POOL_RECYCLE=from_env('DATABASE_POOL_RECYCLE', DATABASE_POOL_RECYCLE),
+        DATABASE_POOL_PRE_PING=from_env('DATABASE_POOL_PRE_PING', DATABASE_POOL_PRE_PING),
+        DATABASE_STATEMENT_TIMEOUT=from_env('DATABASE_STATEMENT_TIMEOUT', DATABASE_STATEMENT_TIMEOUT),
+        DATABASE_REPLICA_URLS=from_env('DATABASE_REPLICA_URLS', DATABASE_REPLICA_URLS),
+        DATABASE_REPLICA_RETRY=from_env('DATABASE_REPLICA_RETRY', DATABASE_REPLICA_RETRY),
+        METRICS_ENABLED=from_env('METRICS_ENABLED', METRICS_ENABLED),
+        JSON_PROVIDER=from_env('JSON_PROVIDER', JSON_PROVIDER),
+        JSON_STREAM_THRESHOLD=from_env('JSON_STREAM_THRESHOLD', JSON_STREAM_THRESHOLD),
+        JSON_STREAM_CHUNK_SIZE=from_env('JSON_STREAM_CHUNK_SIZE', JSON_STREAM_CHUNK_SIZE)
+    )
+    if test_config:
+        app.config.from_mapping(test_config)
+    if app.config['QUIZ_RANDOM_MODE'] not in QUIZ_RANDOM_MODES:
+        raise ValueError(f"QUIZ_RANDOM_MODE must be one of {', '.join(QUIZ_RANDOM_MODES)}")
+    if app.config['SEARCH_BACKEND'] not in SEARCH_BACKENDS:
+        raise ValueError(f"SEARCH_BACKEND must be one of {', '.join(SEARCH_BACKENDS)}")
+    if app.config['JSON_PROVIDER'] not in JSON_PROVIDERS:
+        raise ValueError(f"JSON_PROVIDER must be one of {', '.join(JSON_PROVIDERS)}")
     CORS(app, resources={r"/*": {"origins": "*"}})
 
+    # JSON encoder of the responses, orjson when installed unless JSON_PROVIDER says otherwise
+    app.extensions['json_provider'] = json_provider(
+        app.config['JSON_PROVIDER'], app.config['JSON_SORT_KEYS'], app.config['JSON_AS_ASCII']
+    )
+
     # Setup sqlalchemy database
     setup_db(app)
 
+    # Read replicas for GET and quiz requests, writes always use the primary.
+    # Pooled replica connections are pinged before use so a replica that went
+    # away fails the checkout instead of a statement.
+    replicas = ReplicaRouter(
+        [create_engine(url, **dict(engine_options(app.config, url), pool_pre_ping=True))
+         for url in app.config['DATABASE_REPLICA_URLS']],
+        app.config['DATABASE_REPLICA_RETRY']
+    )
+    app.extensions['replicas'] = replicas
+
+    # Quiz sessions with precomputed shuffled decks
+    quiz_sessions = QuizSessionStore(app.config['QUIZ_SESSION_TTL'], app.config['QUIZ_SESSION_MAX'])
+
+    # In-memory categories, other processes can call invalidate() on
+    # app.extensions['category_registry'] when CATEGORY_REGISTRY_PUBLISH is called
+    category_registry = CategoryRegistry(app.config['CATEGORY_REGISTRY_TTL'], app.config['CATEGORY_REGISTRY_PUBLISH'])
+    app.extensions['category_registry'] = category_registry
+
+    # Approximate search totals
+    search_counts = CountCache(app.config['SEARCH_COUNT_TTL'])
+
+    # Request metrics of this process served on /metrics
+    metrics = Metrics()
+    app.extensions['metrics'] = metrics
+
+    # Rebuild question counts (e.g. after importing rows with plain SQL)
+    @app.cli.command('recount-questions')
+    def recount_questions_command():
+        recount_questions()
+
+    # Add the full-text search index to a database created without it
+    @app.cli.command('create-search-index')
+    def create_search_index_command():
+        create_search_index()
+
+    # Generate synthetic questions for load tests and query plan checks, the
+    # same questions for the same seed
+    @app.cli.command('generate-questions')
+    @click.argument('count', type=int)
+    @click.option('--seed', type=int, default=0)
+    @click.option('--categories', help="weights of category ids like '1=5,2=1', every category equally by default")
+    @click.option('--difficulties', help="weights of difficulties like '1=1,3=2,5=1', every difficulty equally by default")
+    @click.option('--batch-size', type=int, help='questions per bulk insert, BULK_BATCH_SIZE by default')
+    def generate_questions_command(count, seed, categories, difficulties, batch_size):
+        category_ids = [category['id'] for category in category_registry.categories()]
+        if not category_ids:
+            raise click.UsageError('create categories before generating questions')
+
+        try:
+            category_weights = parse_weights(categories) if categories else {category_id: 1 for category_id in category_ids}
+            difficulty_weights = parse_weights(difficulties) if difficulties else None
+        except ValueError as error:
+            raise click.BadParameter(str(error))
+
+        if not set(category_weights) <= set(category_ids):
+            raise click.BadParameter(f"categories {', '.join(map(str, set(category_weights) - set(category_ids)))} don't exist")
+        if difficulty_weights and not set(difficulty_weights) <= {1, 2, 3, 4, 5}:
+            raise click.BadParameter('difficulties are natural ints from 1 to 5 inclusive')
+
+        start = time.perf_counter()
+        rows = generate_questions(count, category_weights, difficulty_weights, seed)
+        written = write_questions(db.session, rows, batch_size or app.config['BULK_BATCH_SIZE'])
+        click.echo(f'generated {written} questions in {time.perf_counter() - start:.1f}s')
+
     # CORS allowed headers and methods
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers',
-                             'Content-Type,Authorization,true')
+                             'Content-Type,Authorization,If-Match,X-Read-Your-Writes,true')
         response.headers.add('Access-Control-Allow-Methods',
                              'GET,PUT,POST,DELETE,OPTIONS')
         return response
 
+    # Latency, status, size and SQL statements of every request, streamed
+    # responses are recorded once their headers are sent and without a size
+    @app.before_request
+    def start_request_metrics():
+        g.sql_statements = 0
+        if app.config['METRICS_ENABLED']:
+            g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'request_start' in g:
+            metrics.observe(
+                request.method,
+                request.url_rule.rule if request.url_rule else 'unmatched',
+                response.status_code,
+                time.perf_counter() - g.request_start,
+                None if response.is_streamed else response.calculate_content_length(),
+                g.sql_statements
+            )
+        return response
+
+    # SQL statement budgets of the views, exceeding one raises while testing
+    # and logs a warning otherwise. Category registry reloads and reads of a
+    # replica that failed (and were run again on the primary) aren't counted.
+    @app.after_request
+    def check_request_query_budget(response):
+        view = app.view_functions.get(request.endpoint)
+        if view is not None and 'sql_statements' in g:
+            statements = g.sql_statements - g.get('registry_statements', 0) - g.get('replica_statements', 0)
+            check_query_budget(view, request.endpoint, statements, app.testing, app.logger)
+        return response
+
+    # Budget of bulk writes that run `statements` however many rows and
+    # categories they touch, imports run them once per batch
+    def bulk_budget(statements, batched=False):
+        if batched:
+            return lambda: g.get('bulk_batches', 0) * statements
+        return statements
+
+    # Conditional GET of listings, the ETag is the data version bumped by every
+    # write so an unchanged If-None-Match is answered with a 304 before the view
+    # runs
+    def conditional(view):
+        @wraps(view)
+        def conditional_view(*args, **kwargs):
+            version = data_version()
+            if version is None:
+                return view(*args, **kwargs)
+
+            g.data_version = version
+            etag = f'v{version}'
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+        return conditional_view
+
+    # Sends the reads of a view to a replica (the primary when none answers)
+    # unless the request asks to read its own writes with X-Read-Your-Writes.
+    # A replica failing the read (e.g. it went away) is marked down and the
+    # read is run again on the primary.
+    def read_replica(view):
+        @wraps(view)
+        def read_replica_view(*args, **kwargs):
+            read_your_writes = request.headers.get('X-Read-Your-Writes', '').lower() in ('1', 'true')
+            engine = replicas.engine() if replicas.engines and not read_your_writes else None
+            if engine is None:
+                return view(*args, **kwargs)
+
+            g.read_engine = engine
+            start = (g.get('sql_statements', 0), g.get('registry_statements', 0))
+            try:
+                return view(*args, **kwargs)
+            except DBAPIError:
+                db.session.rollback()
+                replicas.mark_down(engine)
+                g.read_engine = None
+                if 'sql_statements' in g:
+                    g.replica_statements = (g.sql_statements - start[0]) - (g.get('registry_statements', 0) - start[1])
+
+            return view(*args, **kwargs)
+
+        return read_replica_view
+
     #----------------------------------------------------------------------------#
-    # Questions.
+    # Pagination.
     #----------------------------------------------------------------------------#
 
-    @app.route('/questions', methods=['GET'])
-    def get_questions():
-        questions = []
-        total_questions = 0
+    # Returns (questions, total_questions, next_cursor) for a questions query.
+    # Pages with `cursor`/`after_id` (keyset on id) or `page` (offset), else
+    # returns all questions. next_cursor is None when there is no next page.
+    # Paginated totals come from count_total() instead of a COUNT(*) per page.
+    # A rank expression orders pages and all questions best match first.
+    # Questions are QUESTION_FORMAT_COLUMNS rows, see format_question_row.
+    def paginate_questions(questions_query, count_total, rank=None):
         page = request.args.get('page', None, type=int)
-
-        questions_query = Question.query
-        if page:
+        cursor = request.args.get('cursor', None)
+        after_id = request.args.get('after_id', None, type=int)
+        per_page = request.args.get('per_page', QUESTIONS_PER_PAGE, type=int)
+
+        if per_page < 1:
+            abort(400, 'per_page must be a positive number')
+        per_page = min(per_page, MAX_QUESTIONS_PER_PAGE)
+
+        if cursor is not None:
+            try:
+                after_id = decode_cursor(cursor)
+            except ValueError as error:
+                abort(400, str(error))
+
+        order = [Question.id] if rank is None else [rank, Question.id]
+        questions_query = questions_query.with_entities(*QUESTION_FORMAT_COLUMNS)
+
+        if after_id is not None:
+            if rank is not None:
+                abort(400, 'ranked questions can only be paginated with page')
+
+            # keyset paginated questions, one extra row tells if there is a next page
+            questions = questions_query.filter(Question.id > after_id).order_by(Question.id).limit(per_page + 1).all()
+            total_questions = count_total()
+
+            next_cursor = None
+            if len(questions) > per_page:
+                questions = questions[:per_page]
+                next_cursor = encode_cursor(questions[-1].id)
+
+            return (questions, total_questions, next_cursor)
+        elif page:
             # paginated questions
             if page < 1:
                 abort(400, 'pages are one indexed')
 
-            questions = questions_query.order_by(Question.id).offset((page - 1) * QUESTIONS_PER_PAGE).limit(QUESTIONS_PER_PAGE).all()
-            total_questions = questions_query.count()
+            questions = questions_query.order_by(*order).offset((page - 1) * per_page).limit(per_page).all()
+            total_questions = count_total()
+
+            next_cursor = None
+            if rank is None and questions and (page - 1) * per_page + len(questions) < total_questions:
+                next_cursor = encode_cursor(questions[-1].id)
+
+            return (questions, total_questions, next_cursor)
         else:
             # all questions
-            questions = questions_query.order_by(Question.id).all()
+            questions = questions_query.order_by(*order).all()
             total_questions = len(questions)
 
+            return (questions, total_questions, None)
+
+    # jsonify for data listing question rows in 'questions'. Lists longer
+    # than JSON_STREAM_THRESHOLD are formatted and encoded while being sent.
+    def jsonify_questions(data):
+        questions = data['questions']
+        if len(questions) <= app.config['JSON_STREAM_THRESHOLD']:
+            return jsonify(dict(data, questions=[format_question_row(question) for question in questions]))
+
+        chunks = app.extensions['json_provider'].stream(
+            data, 'questions', map(format_question_row, questions), app.config['JSON_STREAM_CHUNK_SIZE']
+        )
+        return Response(chunks, mimetype=app.config['JSONIFY_MIMETYPE'])
+
+    # Formats registry categories with their question counts (in one query),
+    # question ids are only loaded (in one more) when asked for with ?include=question_ids
+    def format_categories(categories):
+        category_ids = [category['id'] for category in categories]
+        counts = category_question_counts(category_ids)
+        categories = [dict(category, total_questions=counts.get(category['id'], 0)) for category in categories]
+
+        includes = request.args.get('include', '').split(',')
+        if 'question_ids' not in includes:
+            return categories
+
+        question_ids = category_question_ids(category_ids)
+        return [dict(category, questions=question_ids[category['id']]) for category in categories]
+
+    # Returns a count_total for search results, cached unless an exact count is asked for
+    def search_count(key, questions_query):
+        def count_total():
+            if request.args.get('exact_count', 'false').lower() in ('1', 'true'):
+                total_questions = questions_query.count()
+                search_counts.set(key, total_questions)
+                return total_questions
+            return search_counts.get(key, questions_query.count)
+
+        return count_total
+
+    #----------------------------------------------------------------------------#
+    # Questions.
+    #----------------------------------------------------------------------------#
+
+    @app.route('/questions', methods=['GET'])
+    @query_budget(3)
+    @read_replica
+    @conditional
+    def get_questions():
+        questions_query = Question.query
+        (questions, total_questions, next_cursor) = paginate_questions(questions_query, count_questions)
+
         if len(questions) == 0:
             abort(404, 'no questions found')
 
-        return jsonify({
+        return jsonify_questions({
             'success': True,
-            'questions': [question.format() for question in questions],
-            'total_questions': total_questions
+            'questions': questions,
+            'total_questions': total_questions,
+            'next_cursor': next_cursor
         })
 
+    @app.route('/questions/export', methods=['GET'])
+    @query_budget(2)
+    @read_replica
+    @conditional
+    def export_all_questions():
+        export_format = request.args.get('format', 'ndjson')
+        category = request.args.get('category', None, type=int)
+        difficulty = request.args.get('difficulty', None, type=int)
+
+        if export_format not in EXPORT_FORMATS:
+            abort(400, f"export format must be one of {', '.join(EXPORT_FORMATS)}")
+
+        questions_query = Question.query
+        if category is not None:
+            questions_query = questions_query.filter(Question.category_id == category)
+        if difficulty is not None:
+            questions_query = questions_query.filter(Question.difficulty == difficulty)
+
+        # stream the rows in chunks as they are read from the cursor
+        chunk_size = app.config['EXPORT_CHUNK_SIZE']
+        rows = export_rows(questions_query, chunk_size)
+
+        return Response(
+            stream_with_context(export_questions(rows, export_format, chunk_size)),
+            mimetype=EXPORT_FORMATS[export_format],
+            headers={'Content-Disposition': f'attachment; filename=questions.{export_format}'}
+        )
+
+    # A question response with the question version as its ETag, the same
+    # validator If-Match takes when editing the question. An unchanged
+    # If-None-Match on a GET is answered with a 304.
+    def question_response(question_data):
+        etag = str(question_data['version'])
+        if request.method == 'GET' and request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            response = jsonify({
+                'success': True,
+                'question': question_data
+            })
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
     @app.route('/questions/<int:question_id>', methods=['GET'])
+    @query_budget(2)
+    @read_replica
     def get_question(question_id):
         question = Question.query.get(question_id)
 
         if not question:
             abort(404, f'no question found with id {question_id}')
 
-        return jsonify({
-            'success': True,
-            'question': question.format()
-        })
+        return question_response(question.format())
 
     #  Create, search, and play questions
     #  ----------------------------------------------------------------
 
     @app.route('/questions', methods=['POST'])
+    @query_budget(4)
     def post_questions():
         body = request.get_json()
 
@@ -93,32 +475,29 @@ def create_app(test_config=None):
 
     def search_questions(body):
         search_term = body['search_term']
+        if not isinstance(search_term, str):
+            abort(400, 'search term must be a string')
 
-        questions = []
-        total_questions = 0
-        page = request.args.get('page', None, type=int)
+        order = request.args.get('order', 'id')
+        if order not in ('id', 'rank'):
+            abort(400, "order must be either 'id' or 'rank'")
 
-        questions_query = Question.query.filter(Question.question.ilike(f'%{search_term}%'))
-        if page:
-            # paginated questions
-            if page < 1:
-                abort(400, 'pages are one indexed')
+        (questions_query, rank) = search_questions_query(
+            Question.query, search_term, app.config['SEARCH_BACKEND'], ranked=order == 'rank'
+        )
 
-            questions = questions_query.order_by(Question.id).offset((page - 1) * QUESTIONS_PER_PAGE).limit(QUESTIONS_PER_PAGE).all()
-            total_questions = questions_query.count()
-        else:
-            # all questions
-            questions = questions_query.order_by(Question.id).all()
-            total_questions = len(questions)
+        count_total = search_count(('questions', search_term, order), questions_query)
+        (questions, total_questions, next_cursor) = paginate_questions(questions_query, count_total, rank if order == 'rank' else None)
 
         if len(questions) == 0:
             abort(404, f"no questions with search term '{search_term}' found")
 
-        return jsonify({
+        return jsonify_questions({
             'success': True,
             'search_term': search_term,
-            'questions': [question.format() for question in questions],
-            'total_questions': total_questions
+            'questions': questions,
+            'total_questions': total_questions,
+            'next_cursor': next_cursor
         })
 
     def create_question(body):
@@ -126,7 +505,7 @@ def create_app(test_config=None):
             'question': str,
             'answer': str,
             'difficulty': And(Use(int), lambda difficulty: 1 <= difficulty <= 5),
-            'category': And(Use(int), lambda category: Category.query.get(category) is not None)
+            'category': And(Use(int), category_registry.exists)
         })
 
         # validate question input
@@ -159,7 +538,54 @@ def create_app(test_config=None):
                 'question': question_data
             })
 
+    @app.route('/questions/bulk', methods=['POST'])
+    @query_budget(bulk_budget(4, batched=True))
+    def import_questions():
+        bulk_format = BULK_FORMATS.get(request.mimetype)
+
+        if not bulk_format:
+            abort(400, f"bulk import expects one of {', '.join(BULK_FORMATS)}")
+
+        schema = question_schema(category_registry.exists)
+
+        # validate and insert the streamed rows one batch at a time
+        inserted = 0
+        failed = 0
+        errors = []
+        try:
+            for batch in batches(read_rows(request.stream, bulk_format), app.config['BULK_BATCH_SIZE']):
+                g.bulk_batches = g.get('bulk_batches', 0) + 1
+                (rows, batch_errors) = validate_rows(batch, schema)
+                failed += len(batch_errors)
+
+                try:
+                    insert_questions(db.session, rows)
+                    db.session.commit()
+                    inserted += len(rows)
+                except:
+                    db.session.rollback()
+                    failed += len(rows)
+                    batch_errors.append({
+                        'line': batch[0][0],
+                        'description': f"couldn't insert questions from line {batch[0][0]} to {batch[-1][0]}"
+                    })
+
+                errors.extend(batch_errors[:MAX_BULK_ERRORS - len(errors)])
+        except UnicodeDecodeError:
+            abort(400, f'bulk import is not utf-8 encoded after {inserted} questions were imported')
+        finally:
+            db.session.close()
+
+        return jsonify({
+            'success': True,
+            'inserted': inserted,
+            'failed': failed,
+            'errors': errors
+        })
+
     @app.route('/quizzes', methods=['POST'])
+    @query_budget(5)
+    @read_replica
     def play_quizzes():
         body = request.get_json()
 
@@ -167,8 +593,8 @@ def create_app(test_config=None):
             abort(400, 'no json body was found')
 
         schema = Schema({
-            'previous_questions': [And(Use(int), lambda question: Question.query.get(question) is not None)],
-            Optional('quiz_category'): And(Use(int), lambda category: Category.query.get(category) is not None)
+            'previous_questions': [Use(int)],
+            Optional('quiz_category'): And(Use(int), category_registry.exists)
         })
 
         # validate quiz input
@@ -178,59 +604,197 @@ def create_app(test_config=None):
         except:
             abort(400, 'quiz input was bad or not formatted correctly')
 
-        prev_questions = [Question.query.get(question) for question in quiz_data['previous_questions']]
+        # load all previous questions in one query
+        prev_ids = set(quiz_data['previous_questions'])
+        prev_questions = Question.query.filter(Question.id.in_(prev_ids)).all() if prev_ids else []
+        if len(prev_questions) != len(prev_ids):
+            abort(400, 'quiz input was bad or not formatted correctly')
+
+        # unseen questions are counted and sampled inside the database
+        questions_query = Question.query
+
         if 'quiz_category' in quiz_data:
-            category = Category.query.get(quiz_data['quiz_category'])
+            category_id = quiz_data['quiz_category']
 
             for question in prev_questions:
-                if question.category_id != category.id:
+                if question.category_id != category_id:
                     abort(400, 'a question does not belong to category')
 
-            total_questions = len(category.questions) - len(prev_questions)
+            questions_query = questions_query.filter(Question.category_id == category_id)
+            total_questions = count_questions(category_id) - len(prev_questions)
+            question = random_question(questions_query, prev_ids, app.config['QUIZ_RANDOM_MODE']) if total_questions > 0 else None
 
-            if total_questions == 0:
+            if not question:
                 return jsonify({
                     'success': True,
-                    'total_questions': total_questions,
-                    'categoy': category.id
+                    'total_questions': 0,
+                    'categoy': category_id
                 })
 
-            question = list(filter(lambda question: question not in prev_questions, category.questions))[random.randint(0, total_questions - 1)]
-
             return jsonify({
                 'success': True,
                 'question': question.format(),
                 'total_questions': total_questions,
-                'categoy': category.id
+                'categoy': category_id
             })
         else:
-            questions = Question.query.all()
-            total_questions = len(questions) - len(prev_questions)
+            total_questions = count_questions() - len(prev_questions)
+            question = random_question(questions_query, prev_ids, app.config['QUIZ_RANDOM_MODE']) if total_questions > 0 else None
 
-            if total_questions == 0:
+            if not question:
                 return jsonify({
                     'success': True,
-                    'total_questions': total_questions,
+                    'total_questions': 0,
                 })
 
-            question = list(filter(lambda question: question not in prev_questions, questions))[random.randint(0, total_questions - 1)]
-
             return jsonify({
                 'success': True,
                 'question': question.format(),
                 'total_questions': total_questions,
             })
 
+    @app.route('/quizzes/sessions', methods=['POST'])
+    @query_budget(1)
+    @read_replica
+    def create_quiz_session():
+        body = request.get_json(silent=True) or {}
+
+        schema = Schema({
+            Optional('quiz_category'): And(Use(int), category_registry.exists)
+        })
+
+        # validate quiz session input
+        quiz_data = {}
+        try:
+            quiz_data = schema.validate(body)
+        except:
+            abort(400, 'quiz session input was bad or not formatted correctly')
+
+        # build the deck from question ids only, at most QUIZ_SESSION_DECK_SIZE
+        # of them sampled by the database so a session never holds the whole bank
+        questions_query = db.session.query(Question.id)
+        category_id = quiz_data.get('quiz_category', None)
+        if category_id is not None:
+            questions_query = questions_query.filter(Question.category_id == category_id)
+        questions_query = questions_query.order_by(func.random()).limit(app.config['QUIZ_SESSION_DECK_SIZE'])
+        question_ids = [question_id for (question_id,) in questions_query]
+
+        session_id = quiz_sessions.create(category_id, question_ids)
+
+        return jsonify({
+            'success': True,
+            'session': session_id,
+            'total_questions': len(question_ids),
+            'category': category_id
+        })
+
+    @app.route('/quizzes/sessions/<session_id>', methods=['POST'])
+    @query_budget(2)
+    @read_replica
+    def play_quiz_session(session_id):
+        session = quiz_sessions.get(session_id)
+
+        if not session:
+            abort(404, f'no quiz session found with id {session_id}')
+
+        # skip questions deleted since the deck was built, the next ids of the
+        # deck are looked up together so deleted ones don't cost a query each
+        question = None
+        while question is None and session.remaining():
+            question_ids = session.peek(QUIZ_SESSION_LOOKAHEAD)
+            questions = {question.id: question for question in Question.query.filter(Question.id.in_(question_ids))}
+            for question_id in question_ids:
+                session.next_question_id()
+                question = questions.get(question_id)
+                if question:
+                    break
+
+        if not question:
+            return jsonify({
+                'success': True,
+                'session': session_id,
+                'total_questions': 0,
+                'category': session.category_id
+            })
+
+        return jsonify({
+            'success': True,
+            'session': session_id,
+            'question': question.format(),
+            'total_questions': session.remaining() + 1,
+            'category': session.category_id
+        })
+
+    @app.route('/quizzes/sessions/<session_id>', methods=['DELETE'])
+    @query_budget(0)
+    def delete_quiz_session(session_id):
+        if not quiz_sessions.delete(session_id):
+            abort(404, f'no quiz session found with id {session_id}')
+
+        return jsonify({
+            'success': True,
+            'session': session_id
+        })
+
     #  Edit and delete questions
     #  ----------------------------------------------------------------
 
-    @app.route('/questions/<int:question_id>', methods=['PUT'])
-    def edit_question(question_id):
-        question = Question.query.get(question_id)
+    # Returns the question version an edit is conditional on, taken from an
+    # If-Match header or a version field, None for unconditional edits
+    def expected_version(question_data):
+        version = question_data.pop('version', None)
 
-        if not question:
+        if request.if_match and not request.if_match.star_tag:
+            etags = request.if_match.as_set()
+            if len(etags) != 1 or not next(iter(etags)).isdigit():
+                abort(400, 'If-Match must be a single question version')
+
+            if_match_version = int(next(iter(etags)))
+            if version is not None and version != if_match_version:
+                abort(400, "If-Match and version don't match")
+            version = if_match_version
+
+        return version
+
+    # Runs a single statement write of a question, aborting with 422 when no
+    # question has the id and with 409 when it was edited since `version`.
+    # Edits answer with the new question version as the ETag.
+    def write_question(question_id, write, message, version=None, etag=False):
+        error = False
+        conflict = False
+        question_data = None
+        try:
+            question_data = write(db.session)
+            if question_data is None:
+                db.session.rollback()
+                # tell a stale edit from a missing question
+                conflict = version is not None and \
+                    db.session.query(Question.id).filter(Question.id == question_id).first() is not None
+            else:
+                db.session.commit()
+        except:
+            db.session.rollback()
+            error = True
+        finally:
+            db.session.close()
+
+        if error:
+            abort(500, message)
+        elif conflict:
+            abort(409, f'question {question_id} was edited since version {version}')
+        elif question_data is None:
             abort(422, f'no question found with id {question_id}')
+        elif etag:
+            return question_response(question_data)
+        else:
+            return jsonify({
+                'success': True,
+                'question': question_data
+            })
 
+    @app.route('/questions/<int:question_id>', methods=['PUT'])
+    @query_budget(6)
+    def edit_question(question_id):
         body = request.get_json()
         if not body:
             abort(400, 'no json body was found')
@@ -239,7 +803,8 @@ def create_app(test_config=None):
             'question': str,
             'answer': str,
             'difficulty': And(Use(int), lambda difficulty: 1 <= difficulty <= 5),
-            'category': And(Use(int), lambda category: Category.query.get(category) is not None)
+            'category': And(Use(int), category_registry.exists),
+            Optional('version'): Use(int)
         })
 
         # validate question input
@@ -249,71 +814,120 @@ def create_app(test_config=None):
         except:
             abort(400, 'input question was bad or not formatted correctly')
 
-        # edit question
-        question.question = question_data['question']
-        question.answer = question_data['answer']
-        question.difficulty = question_data['difficulty']
-        question.category_id = question_data['category']
+        version = expected_version(question_data)
+        values = {
+            'question': question_data['question'],
+            'answer': question_data['answer'],
+            'difficulty': question_data['difficulty'],
+            'category_id': question_data['category']
+        }
+
+        # edit question in database with one statement
+        return write_question(
+            question_id,
+            lambda session: update_question_row(session, question_id, values, version),
+            "couldn't edit question",
+            version,
+            etag=True
+        )
 
-        # edit question in database
-        error = False
+    @app.route('/questions/<int:question_id>', methods=['PATCH'])
+    @query_budget(6)
+    def edit_question_partially(question_id):
+        body = request.get_json()
+        if not body:
+            abort(400, 'no json body was found')
+
+        schema = Schema({
+            Optional('question'):  str,
+            Optional('answer'): str,
+            Optional('difficulty'): And(Use(int), lambda difficulty: 1 <= difficulty <= 5),
+            Optional('category'): And(Use(int), category_registry.exists),
+            Optional('version'): Use(int)
+        })
+
+        # validate question input
+        question_data = {}
         try:
-            db.session.commit()
-            question_data = question.format()
+            question_data = schema.validate(body)
         except:
-            db.session.rollback()
-            error = True
-        finally:
-            db.session.close()
+            abort(400, 'input question was bad or not formatted correctly')
 
-        if error:
-            abort(500, "couldn't edit question")
-        else:
-            return jsonify({
-                'success': True,
-                'question': question_data
-            })
+        version = expected_version(question_data)
+        if not question_data:
+            abort(400, 'input question was bad or not formatted correctly')
 
-    @app.route('/questions/<int:question_id>', methods=['PATCH'])
-    def edit_question_partially(question_id):
-        question = Question.query.get(question_id)
+        values = {('category_id' if key == 'category' else key): value for (key, value) in question_data.items()}
 
-        if not question:
-            abort(422, f'no question found with id {question_id}')
+        # edit question in database with one statement
+        return write_question(
+            question_id,
+            lambda session: update_question_row(session, question_id, values, version),
+            "couldn't edit question",
+            version,
+            etag=True
+        )
+
+    @app.route('/questions/<int:question_id>', methods=['DELETE'])
+    @query_budget(4)
+    def delete_question(question_id):
+        # delete question from database with one statement
+        return write_question(
+            question_id,
+            lambda session: delete_question_row(session, question_id),
+            "couldn't delete question"
+        )
+
+    #  Edit and delete many questions
+    #  ----------------------------------------------------------------
+
+    # Returns the questions query selected by ids or a filter of the body
+    def bulk_selection(body):
+        selection = {}
+        try:
+            selection = selection_schema().validate(body)
+        except:
+            abort(400, 'input selection was bad or not formatted correctly')
 
+        questions_query = selection_query(selection)
+        if questions_query is None:
+            abort(400, 'select questions with either ids or a non empty filter')
+        return questions_query
+
+    @app.route('/questions/bulk', methods=['PATCH'])
+    @query_budget(bulk_budget(5))
+    def edit_questions_in_bulk():
         body = request.get_json()
         if not body:
             abort(400, 'no json body was found')
 
+        questions_query = bulk_selection(body)
+
         schema = Schema({
             Optional('question'):  str,
             Optional('answer'): str,
             Optional('difficulty'): And(Use(int), lambda difficulty: 1 <= difficulty <= 5),
-            Optional('category'): And(Use(int), lambda category: Category.query.get(category) is not None)
+            Optional('category'): And(Use(int), category_registry.exists)
         })
 
         # validate question input
         question_data = {}
         try:
-            question_data = schema.validate(body)
+            question_data = schema.validate(body.get('values'))
         except:
             abort(400, 'input question was bad or not formatted correctly')
 
-        # edit question
-        if 'question' in question_data:
-            question.question = question_data['question']
-        if 'answer' in question_data:
-            question.answer = question_data['answer']
-        if 'difficulty' in question_data:
-            question.difficulty = question_data['difficulty']
-        if 'category' in question_data:
-            question.category_id = question_data['category']
-
-        # edit question in database
+        if not question_data:
+            abort(400, 'input question was bad or not formatted correctly')
+
+        values = {('category_id' if key == 'category' else key): value for (key, value) in question_data.items()}
+
+        # edit questions in database with one statement
         error = False
+        questions = []
         try:
+            questions = update_questions(db.session, questions_query, values)
             db.session.commit()
-            question_data = question.format()
         except:
             db.session.rollback()
             error = True
@@ -321,25 +935,28 @@ def create_app(test_config=None):
             db.session.close()
 
         if error:
-            abort(500, "")
+            abort(500, "couldn't edit questions")
         else:
             return jsonify({
                 'success': True,
-                'question': question_data
+                'questions': [question_id for (question_id, _) in questions],
+                'total_questions': len(questions)
             })
 
-    @app.route('/questions/<int:question_id>', methods=['DELETE'])
-    def delete_question(question_id):
-        question = Question.query.get(question_id)
+    @app.route('/questions/bulk', methods=['DELETE'])
+    @query_budget(bulk_budget(4))
+    def delete_questions_in_bulk():
+        body = request.get_json()
+        if not body:
+            abort(400, 'no json body was found')
 
-        if not question:
-            abort(422, f'no question found with id {question_id}')
+        questions_query = bulk_selection(body)
 
-        # delete question from database
+        # delete questions from database with one statement
         error = False
+        questions = []
         try:
-            question_data = question.format()
-            db.session.delete(question)
+            questions = delete_questions(db.session, questions_query)
             db.session.commit()
         except:
             db.session.rollback()
@@ -348,11 +965,12 @@ def create_app(test_config=None):
             db.session.close()
 
         if error:
-            abort(500, "couldn't delete question")
+            abort(500, "couldn't delete questions")
         else:
             return jsonify({
                 'success': True,
-                'question': question_data
+                'questions': [question_id for (question_id, _) in questions],
+                'total_questions': len(questions)
             })
 
     #----------------------------------------------------------------------------#
@@ -360,67 +978,66 @@ def create_app(test_config=None):
     #----------------------------------------------------------------------------#
 
     @app.route('/categories', methods=['GET'])
+    @query_budget(3)
+    @read_replica
+    @conditional
     def get_categories():
-        categories = Category.query.order_by(Category.id).all()
+        categories = category_registry.categories()
 
         if len(categories) == 0:
             abort(404, 'no categories found')
 
         return jsonify({
             'success': True,
-            'categories': [category.format() for category in categories],
+            'categories': format_categories(categories),
         })
 
     @app.route('/categories/<int:category_id>', methods=['GET'])
+    @query_budget(2)
+    @read_replica
+    @conditional
     def get_category(category_id):
-        category = Category.query.get(category_id)
+        category = category_registry.get(category_id)
 
         if not category:
             abort(404, f'no category found with id {category_id}')
 
         return jsonify({
             'success': True,
-            'category': category.format()
+            'category': format_categories([category])[0]
         })
 
     @app.route('/categories/<int:category_id>/questions', methods=['GET'])
+    @query_budget(3)
+    @read_replica
+    @conditional
     def get_category_questions(category_id):
-        category = Category.query.get(category_id)
+        category = category_registry.get(category_id)
 
         if not category:
             abort(404, f'no category found with id {category_id}')
 
-        questions = []
-        total_questions = 0
-        page = request.args.get('page', None, type=int)
-
-        if page:
-            # paginated questions
-            if page < 1:
-                abort(400, 'pages are one indexed')
-
-            start = (page - 1) * QUESTIONS_PER_PAGE
-            end = start + QUESTIONS_PER_PAGE - 1
-            questions = category.questions[start:end]
-            total_questions = len(category.questions)
-        else:
-            # all questions
-            questions = category.questions
-            total_questions = len(questions)
+        # page in the database, the total is the category question count
+        category = format_categories([category])[0]
+        questions_query = Question.query.filter(Question.category_id == category_id)
+        (questions, total_questions, next_cursor) = paginate_questions(questions_query, lambda: category['total_questions'])
 
         if len(questions) == 0:
             abort(404, f"no questions found in category {category_id}")
 
-        return jsonify({
+        return jsonify_questions({
             'success': True,
-            'category': category.format(),
-            'questions': [question.format() for question in questions],
-            'total_questions': total_questions
+            'category': category,
+            'questions': questions,
+            'total_questions': total_questions,
+            'next_cursor': next_cursor
         })
 
     @app.route('/categories/<int:category_id>/questions', methods=['POST'])
+    # PostgreSQL regex searches run one more statement, their SET LOCAL statement_timeout
+    @query_budget(4)
     def search_category_questions(category_id):
-        category = Category.query.get(category_id)
+        category = category_registry.get(category_id)
 
         if not category:
             abort(404, f'no category found with id {category_id}')
@@ -434,38 +1051,82 @@ def create_app(test_config=None):
             abort(400, 'no search term found')
 
         search_term = body['search_term']
+        if not isinstance(search_term, str):
+            abort(400, 'search term must be a string')
+        regex = body.get('regex', False) is True
+
+        # filter and paginate the category questions in the database
+        questions_query = Question.query.filter(Question.category_id == category_id)
+        if regex:
+            try:
+                questions_query = regex_questions_query(questions_query, search_term)
+            except ValueError as error:
+                abort(400, str(error))
+        else:
+            questions_query = search_questions_query(questions_query, search_term, app.config['SEARCH_BACKEND'])[0]
 
-        questions = []
-        total_questions = 0
-        page = request.args.get('page', None, type=int)
-
-        questions_data = list(filter(lambda question: re.search(r"{}".format(search_term), question.question, re.IGNORECASE) is not None, category.questions))
-
-        if page:
-            # paginated questions
-            if page < 1:
-                abort(400, 'pages are one indexed')
-
-            start = (page - 1) * QUESTIONS_PER_PAGE
-            end = start + QUESTIONS_PER_PAGE - 1
-            questions = questions_data[start:end]
-            total_questions = len(questions_data)
+        count_total = search_count((category_id, search_term, regex), questions_query)
+        if not regex:
+            (questions, total_questions, next_cursor) = paginate_questions(questions_query, count_total)
         else:
-            # all questions
-            questions = questions_data
-            total_questions = len(questions)
+            # the pattern runs in the database, which may time out or reject it
+            timed_out = None
+            try:
+                with regex_timeout(app.config['SEARCH_REGEX_TIMEOUT']):
+                    (questions, total_questions, next_cursor) = paginate_questions(questions_query, count_total)
+            except DBAPIError as error:
+                db.session.rollback()
+                timed_out = regex_timed_out(error)
+
+            if timed_out:
+                abort(422, f"regex search takes longer than {app.config['SEARCH_REGEX_TIMEOUT']} ms or backtracks too much on a question")
+            elif timed_out is not None:
+                abort(400, 'regex is not supported by the database')
 
         if len(questions) == 0:
             abort(404, f"no questions with search term '{search_term}' found in category {category_id}")
 
-        return jsonify({
+        return jsonify_questions({
             'success': True,
-            'category': category.format(),
-            'questions': [question.format() for question in questions],
+            'category': format_categories([category])[0],
+            'questions': questions,
             'total_questions': total_questions,
+            'next_cursor': next_cursor,
             'search_term': search_term
         })
 
+    #----------------------------------------------------------------------------#
+    # Health.
+    #----------------------------------------------------------------------------#
+
+    # Reports whether the database answers and the connection pool stats of
+    # this process, 503 when the database is unavailable
+    @app.route('/health')
+    @query_budget(1)
+    def health():
+        database = 'ok'
+        try:
+            db.session.execute(text('SELECT 1'))
+        except:
+            database = 'unavailable'
+        finally:
+            db.session.close()
+
+        return jsonify({
+            'success': database == 'ok',
+            'database': database,
+            'pool': pool_stats(db.engine.pool),
+            'replicas': replicas.stats()
+        }), 200 if database == 'ok' else 503
+
+    @app.route('/metrics')
+    @query_budget(0)
+    def get_metrics():
+        if not app.config['METRICS_ENABLED']:
+            abort(404, 'metrics are disabled')
+
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
     #----------------------------------------------------------------------------#
     # Error Handling.
     #----------------------------------------------------------------------------#
@@ -497,6 +1158,15 @@ def create_app(test_config=None):
             'description': error.description
         }), 405
 
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            'success': False,
+            'error': 409,
+            'message': 'conflict',
+            'description': error.description
+        }), 409
+
     @app.errorhandler(422)
     def unprocessable(error):
         return jsonify({
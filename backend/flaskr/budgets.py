@@ -0,0 +1,32 @@
+# Per-endpoint SQL statement budgets. Views declare how many statements a
+# request may run, the request metrics hooks count them (see metrics.py) and
+# compare the count with the budget once the response is ready.
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+# Must be the decorator right under @app.route so the budget lands on the
+# registered view. `statements` can be a function called after the request
+# for views whose statements grow with their input.
+def query_budget(statements):
+    def decorator(view):
+        view.query_budget = statements
+        return view
+
+    return decorator
+
+
+# Raises QueryBudgetExceeded when `strict`, else logs a warning with `logger`
+def check_query_budget(view, endpoint, statements, strict, logger):
+    budget = getattr(view, 'query_budget', None)
+    if callable(budget):
+        budget = budget()
+    if budget is None or statements <= budget:
+        return
+
+    message = f'{endpoint} ran {statements} SQL statements, over its budget of {budget}'
+    if strict:
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
@@ -0,0 +1,355 @@
+import csv
+import io
+import json
+from collections import Counter
+
+from schema import Schema, And, Use, Optional
+from sqlalchemy import delete, select, update
+
+from .models import db, Question, adjust_question_counts, bump_data_version
+
+BULK_FORMATS = {
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+    'text/csv': 'csv'
+}
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+QUESTION_COLUMNS = ['id', 'question', 'answer', 'difficulty', 'category', 'version']
+
+
+#----------------------------------------------------------------------------#
+# Reading.
+#----------------------------------------------------------------------------#
+
+# Yields (line, row) for every record of a byte stream, row is None when the
+# record can't be parsed. Reads one line at a time so memory stays bounded.
+def read_rows(stream, bulk_format):
+    lines = (line.decode('utf-8') for line in stream)
+
+    if bulk_format == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield (reader.line_num, row if None not in row else None)
+        return
+
+    for (line, text) in enumerate(lines, 1):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+        except ValueError:
+            row = None
+        yield (line, row if isinstance(row, dict) else None)
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+#----------------------------------------------------------------------------#
+# Validation.
+#----------------------------------------------------------------------------#
+
+def question_schema(category_exists):
+    # exported rows carry an id and a version which are ignored on import
+    return Schema({
+        Optional('id'): object,
+        Optional('version'): object,
+        'question': str,
+        'answer': str,
+        'difficulty': And(Use(int), lambda difficulty: 1 <= difficulty <= 5),
+        'category': And(Use(int), category_exists)
+    })
+
+
+# Returns (rows, errors) where rows are ready to insert into questions
+def validate_rows(batch, schema):
+    rows = []
+    errors = []
+    for (line, row) in batch:
+        try:
+            if row is None:
+                raise ValueError()
+            question_data = schema.validate(row)
+        except Exception:
+            errors.append({
+                'line': line,
+                'description': 'input question was bad or not formatted correctly'
+            })
+            continue
+
+        rows.append({
+            'question': question_data['question'],
+            'answer': question_data['answer'],
+            'difficulty': question_data['difficulty'],
+            'category_id': question_data['category']
+        })
+    return (rows, errors)
+
+
+#----------------------------------------------------------------------------#
+# Inserting.
+#----------------------------------------------------------------------------#
+
+# CSV of rows for COPY, every value is quoted since COPY reads an unquoted
+# empty value (e.g. an empty answer) as NULL
+def copy_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+    for row in rows:
+        writer.writerow([row['question'], row['answer'], row['difficulty'], row['category_id']])
+    buffer.seek(0)
+    return buffer
+
+
+def copy_questions(session, rows):
+    buffer = copy_csv(rows)
+
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert('COPY questions (question, answer, difficulty, category_id) FROM STDIN WITH (FORMAT csv)', buffer)
+    finally:
+        cursor.close()
+
+
+# Inserts rows with COPY on PostgreSQL and a multi-row INSERT elsewhere, the
+# question counts and data version are kept in the same transaction since
+# these statements skip the session flush events
+def insert_questions(session, rows):
+    if not rows:
+        return
+
+    if db.engine.dialect.name == 'postgresql':
+        copy_questions(session, rows)
+    else:
+        session.execute(Question.__table__.insert(), rows)
+
+    adjust_question_counts(session, Counter(row['category_id'] for row in rows))
+    bump_data_version(session)
+
+
+#----------------------------------------------------------------------------#
+# Editing and deleting.
+#----------------------------------------------------------------------------#
+
+def selection_schema():
+    return Schema({
+        Optional('ids'): [Use(int)],
+        Optional('filter'): {
+            Optional('category'): Use(int),
+            Optional('difficulty'): Use(int)
+        }
+    }, ignore_extra_keys=True)
+
+
+# Returns the questions query of a validated selection of either ids or a
+# non empty filter, None when the selection is neither
+def selection_query(selection):
+    if ('ids' in selection) == ('filter' in selection):
+        return None
+
+    if 'ids' in selection:
+        return Question.query.filter(Question.id.in_(selection['ids']))
+
+    if not selection['filter']:
+        return None
+
+    questions_query = Question.query
+    if 'category' in selection['filter']:
+        questions_query = questions_query.filter(Question.category_id == selection['filter']['category'])
+    if 'difficulty' in selection['filter']:
+        questions_query = questions_query.filter(Question.difficulty == selection['filter']['difficulty'])
+    return questions_query
+
+
+# Locks the selected questions and returns their (id, category_id)
+def lock_questions(questions_query):
+    return questions_query.with_entities(Question.id, Question.category_id) \
+        .order_by(Question.id).with_for_update().all()
+
+
+# Updates the selected questions with a single UPDATE ... RETURNING and returns
+# their (id, old category_id) by id. The old categories are read from a locked
+# sub-select of the same statement, like update_question_row. SQLite locks and
+# reads the selection first and then updates it by id.
+def update_questions(session, questions_query, values):
+    questions = Question.__table__
+    values = dict(values, version=questions.c.version + 1)
+
+    if db.engine.dialect.name == 'postgresql':
+        old = select(questions.c.id, questions.c.category_id.label('old_category_id')) \
+            .where(questions_query.whereclause).order_by(questions.c.id).with_for_update().subquery()
+        rows = session.execute(
+            update(questions).where(questions.c.id == old.c.id).values(**values)
+            .returning(questions.c.id, old.c.old_category_id)
+        ).all()
+    else:
+        rows = lock_questions(questions_query)
+        if rows:
+            ids = [question_id for (question_id, _) in rows]
+            session.execute(update(questions).where(questions.c.id.in_(ids)).values(**values))
+
+    rows = sorted(tuple(row) for row in rows)
+    if rows:
+        if 'category_id' in values:
+            deltas = Counter()
+            for (_, category_id) in rows:
+                deltas[category_id] -= 1
+                deltas[values['category_id']] += 1
+            adjust_question_counts(session, deltas)
+        bump_data_version(session)
+    return rows
+
+
+# Deletes the selected questions with a single DELETE ... RETURNING and
+# returns their (id, category_id) by id. SQLite locks and reads the selection
+# first and then deletes it by id.
+def delete_questions(session, questions_query):
+    questions = Question.__table__
+
+    if db.engine.dialect.name == 'postgresql':
+        rows = session.execute(
+            delete(questions).where(questions_query.whereclause).returning(questions.c.id, questions.c.category_id)
+        ).all()
+    else:
+        rows = lock_questions(questions_query)
+        if rows:
+            ids = [question_id for (question_id, _) in rows]
+            session.execute(delete(questions).where(questions.c.id.in_(ids)))
+
+    rows = sorted(tuple(row) for row in rows)
+    if rows:
+        deltas = Counter()
+        for (_, category_id) in rows:
+            deltas[category_id] -= 1
+        adjust_question_counts(session, deltas)
+        bump_data_version(session)
+    return rows
+
+
+def question_columns():
+    questions = Question.__table__
+    return [
+        questions.c.id,
+        questions.c.question,
+        questions.c.answer,
+        questions.c.difficulty,
+        questions.c.category_id,
+        questions.c.version
+    ]
+
+
+# Updates a question with a single UPDATE ... RETURNING and returns it
+# formatted, None when no question has the id or, when `version` is given,
+# when the question was edited since that version. The old category is read
+# from a locked sub-select of the same statement so its count can be moved.
+# SQLAlchemy can't compile RETURNING for SQLite so the row is read around a
+# plain UPDATE there.
+def update_question_row(session, question_id, values, version=None):
+    questions = Question.__table__
+    values = dict(values, version=questions.c.version + 1)
+
+    if db.engine.dialect.name == 'postgresql':
+        old = select(questions.c.id, questions.c.category_id.label('old_category_id')) \
+            .where(questions.c.id == question_id).with_for_update().subquery()
+        statement = update(questions).where(questions.c.id == old.c.id)
+        if version is not None:
+            statement = statement.where(questions.c.version == version)
+        row = session.execute(
+            statement.values(**values).returning(*question_columns(), old.c.old_category_id)
+        ).first()
+    else:
+        old = session.execute(
+            select(questions.c.category_id, questions.c.version).where(questions.c.id == question_id)
+        ).first()
+        row = None
+        if old is not None and (version is None or old.version == version):
+            session.execute(update(questions).where(questions.c.id == question_id).values(**values))
+            row = tuple(session.execute(select(*question_columns()).where(questions.c.id == question_id)).first()) \
+                + (old.category_id,)
+
+    if row is None:
+        return None
+
+    question = dict(zip(QUESTION_COLUMNS, row[:-1]))
+    old_category_id = row[-1]
+    if question['category'] != old_category_id:
+        adjust_question_counts(session, Counter({old_category_id: -1, question['category']: 1}))
+    bump_data_version(session)
+    return question
+
+
+# Deletes a question with a single DELETE ... RETURNING and returns it
+# formatted, None when no question has the id
+def delete_question_row(session, question_id):
+    questions = Question.__table__
+
+    if db.engine.dialect.name == 'postgresql':
+        row = session.execute(
+            delete(questions).where(questions.c.id == question_id).returning(*question_columns())
+        ).first()
+    else:
+        row = session.execute(select(*question_columns()).where(questions.c.id == question_id)).first()
+        if row is not None:
+            session.execute(delete(questions).where(questions.c.id == question_id))
+
+    if row is None:
+        return None
+
+    question = dict(zip(QUESTION_COLUMNS, row))
+    adjust_question_counts(session, Counter({question['category']: -1}))
+    bump_data_version(session)
+    return question
+
+
+#----------------------------------------------------------------------------#
+# Exporting.
+#----------------------------------------------------------------------------#
+
+# Reads the questions through a server-side cursor `chunk_size` rows at a time
+def export_rows(questions_query, chunk_size):
+    return questions_query.with_entities(
+        Question.id,
+        Question.question,
+        Question.answer,
+        Question.difficulty,
+        Question.category_id,
+        Question.version
+    ).order_by(Question.id).yield_per(chunk_size)
+
+
+def export_ndjson(rows, chunk_size):
+    for chunk in batches(rows, chunk_size):
+        yield ''.join(json.dumps(dict(zip(QUESTION_COLUMNS, row))) + '\n' for row in chunk)
+
+
+def export_csv(rows, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(QUESTION_COLUMNS)
+    for chunk in batches(rows, chunk_size):
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_questions(rows, export_format, chunk_size):
+    if export_format == 'csv':
+        return export_csv(rows, chunk_size)
+    return export_ndjson(rows, chunk_size)
@@ -0,0 +1,103 @@
+import json
+import re
+
+from flask import Response, current_app
+from flask.json import JSONEncoder
+
+from .bulk import batches
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_PROVIDERS = ('auto', 'orjson', 'stdlib')
+NON_ASCII_BYTES = re.compile(rb'[\x7f-\xff]')
+NON_ASCII = re.compile(r'[^\x00-\x7e]')
+
+
+# Encodes response bodies. Both providers write compact JSON with sorted keys
+# and escape non ASCII characters unless JSON_AS_ASCII is off, the bytes of
+# jsonify, so questions encode the same whichever provider is used.
+# Subclasses define dumps(obj) returning bytes.
+class JSONProvider:
+    name = None
+
+    def __init__(self, sort_keys=True, ensure_ascii=True):
+        self.sort_keys = sort_keys
+        self.ensure_ascii = ensure_ascii
+
+    def response(self, data):
+        return Response(self.dumps(data) + b'\n', mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+    # Yields the bytes of response() for `data` with the `key` array encoded
+    # `chunk_size` items at a time, so the whole body is never held in memory
+    def stream(self, data, key, items, chunk_size):
+        keys = sorted(data) if self.sort_keys else list(data)
+
+        yield b'{'
+        for (index, name) in enumerate(keys):
+            prefix = (b',' if index else b'') + self.dumps(name) + b':'
+            if name != key:
+                yield prefix + self.dumps(data[name])
+                continue
+
+            yield prefix + b'['
+            for (position, chunk) in enumerate(batches(items, chunk_size)):
+                # a chunk encoded as one array, without its brackets
+                yield (b',' if position else b'') + self.dumps(chunk)[1:-1]
+            yield b']'
+        yield b'}\n'
+
+
+class StdlibJSONProvider(JSONProvider):
+    name = 'stdlib'
+
+    def dumps(self, obj):
+        return json.dumps(
+            obj,
+            cls=JSONEncoder,
+            separators=(',', ':'),
+            sort_keys=self.sort_keys,
+            ensure_ascii=self.ensure_ascii
+        ).encode()
+
+
+class OrjsonJSONProvider(JSONProvider):
+    name = 'orjson'
+
+    def __init__(self, sort_keys=True, ensure_ascii=True):
+        super().__init__(sort_keys, ensure_ascii)
+        self.option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        # types orjson doesn't know (e.g. Decimal) are converted like flask does
+        self.default = JSONEncoder().default
+
+    def dumps(self, obj):
+        data = orjson.dumps(obj, default=self.default, option=self.option)
+        if self.ensure_ascii and NON_ASCII_BYTES.search(data):
+            # orjson only writes UTF-8, escape like json.dumps(ensure_ascii=True)
+            data = NON_ASCII.sub(escape_non_ascii, data.decode()).encode()
+        return data
+
+
+def escape_non_ascii(match):
+    code = ord(match.group())
+    if code > 0xffff:
+        code -= 0x10000
+        return '\\u{0:04x}\\u{1:04x}'.format(0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff))
+    return '\\u{0:04x}'.format(code)
+
+
+# Returns the provider named `name`, 'auto' picks orjson when it is installed
+def json_provider(name, sort_keys=True, ensure_ascii=True):
+    if name == 'orjson' and orjson is None:
+        raise ValueError('JSON_PROVIDER is orjson but orjson is not installed')
+
+    if name == 'orjson' or (name == 'auto' and orjson is not None):
+        return OrjsonJSONProvider(sort_keys, ensure_ascii)
+    return StdlibJSONProvider(sort_keys, ensure_ascii)
+
+
+# flask.jsonify through the provider of the app
+def jsonify(data):
+    return current_app.extensions['json_provider'].response(data)
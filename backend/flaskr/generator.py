@@ -0,0 +1,61 @@
+import random
+from itertools import accumulate
+
+from .bulk import batches, insert_questions
+
+QUESTION_WORDS = ['Who', 'What', 'Which', 'Where', 'When', 'How', 'Why', 'In which', 'How many']
+WORDS = [
+    'the', 'of', 'in', 'a', 'first', 'largest', 'famous', 'only', 'river', 'painting', 'country',
+    'team', 'world', 'cup', 'city', 'organ', 'human', 'body', 'artist', 'movie', 'actor', 'author',
+    'king', 'queen', 'war', 'planet', 'element', 'ocean', 'invented', 'discovered', 'wrote', 'won',
+    'played', 'built', 'named', 'known', 'capital', 'language', 'century', 'album', 'novel', 'island',
+    'mountain', 'empire', 'scientist', 'composer', 'record', 'championship', 'symbol', 'animal'
+]
+DIFFICULTIES = [1, 2, 3, 4, 5]
+
+
+# Parses weights like '1=5,2=1' into {1: 5.0, 2: 1.0}, raising a ValueError
+def parse_weights(text):
+    weights = {}
+    for item in text.split(','):
+        (key, weight) = item.split('=')
+        weights[int(key)] = float(weight)
+
+    if not weights or any(weight < 0 for weight in weights.values()) or not sum(weights.values()):
+        raise ValueError(f'invalid weights {text}')
+    return weights
+
+
+def sentence(rng, mean, deviation, low, high):
+    length = min(max(int(rng.gauss(mean, deviation)), low), high)
+    return ' '.join(rng.choices(WORDS, k=length))
+
+
+# Yields `count` question rows, the same ones for the same seed. Questions
+# are 4 to 30 words long (11 on average) and answers 1 to 5 words.
+def generate_questions(count, category_weights, difficulty_weights=None, seed=0):
+    rng = random.Random(seed)
+    category_ids = list(category_weights)
+    category_cum_weights = list(accumulate(category_weights[category_id] for category_id in category_ids))
+    difficulty_cum_weights = list(accumulate(
+        difficulty_weights.get(difficulty, 0) if difficulty_weights else 1 for difficulty in DIFFICULTIES
+    ))
+
+    for _ in range(count):
+        yield {
+            'question': f'{rng.choice(QUESTION_WORDS)} {sentence(rng, 10, 4, 3, 29)}?',
+            'answer': sentence(rng, 2, 1, 1, 5).title(),
+            'difficulty': rng.choices(DIFFICULTIES, cum_weights=difficulty_cum_weights)[0],
+            'category_id': rng.choices(category_ids, cum_weights=category_cum_weights)[0]
+        }
+
+
+# Writes rows through the bulk insert path (COPY on PostgreSQL), committing
+# every batch, and returns how many were written
+def write_questions(session, rows, batch_size):
+    written = 0
+    for batch in batches(rows, batch_size):
+        insert_questions(session, batch)
+        session.commit()
+        written += len(batch)
+    return written
@@ -0,0 +1,114 @@
+import threading
+from bisect import bisect_left
+from collections import Counter
+
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Request metrics of a process kept in plain dicts under one lock, so
+# recording a request is a few increments and nothing else
+class Metrics:
+    def __init__(self):
+        self.requests = Counter()
+        self.errors = Counter()
+        self.latency = {}
+        self.sizes = {}
+        self.statements = {}
+        self._lock = threading.Lock()
+
+    # size is None when unknown (streamed responses)
+    def observe(self, method, route, status, duration, size, statements):
+        with self._lock:
+            self.requests[(method, route, status)] += 1
+            if status >= 400:
+                self.errors[(method, route, status)] += 1
+
+            self._histogram(self.latency, (method, route), LATENCY_BUCKETS).observe(duration)
+            self._histogram(self.statements, (method, route), STATEMENT_BUCKETS).observe(statements)
+            if size is not None:
+                self._histogram(self.sizes, (method, route), SIZE_BUCKETS).observe(size)
+
+    def render(self):
+        with self._lock:
+            lines = []
+            render_counter(lines, 'trivia_http_requests_total', 'Requests by route and status.', self.requests)
+            render_counter(lines, 'trivia_http_request_errors_total', 'Requests answered with an error status.', self.errors)
+            render_histogram(lines, 'trivia_http_request_duration_seconds', 'Request latency by route.', self.latency)
+            render_histogram(lines, 'trivia_http_response_size_bytes', 'Response size by route.', self.sizes)
+            render_histogram(lines, 'trivia_http_request_sql_statements', 'SQL statements per request by route.', self.statements)
+            return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _histogram(histograms, key, buckets):
+        if key not in histograms:
+            histograms[key] = Histogram(buckets)
+        return histograms[key]
+
+
+#----------------------------------------------------------------------------#
+# Prometheus text format.
+#----------------------------------------------------------------------------#
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(**labels):
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for (name, value) in labels.items()) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render_counter(lines, name, description, counter):
+    lines.append(f'# HELP {name} {description}')
+    lines.append(f'# TYPE {name} counter')
+    for ((method, route, status), value) in sorted(counter.items()):
+        lines.append(f'{name}{format_labels(method=method, route=route, status=status)} {value}')
+
+
+def render_histogram(lines, name, description, histograms):
+    lines.append(f'# HELP {name} {description}')
+    lines.append(f'# TYPE {name} histogram')
+    for ((method, route), histogram) in sorted(histograms.items()):
+        cumulative = 0
+        for (bucket, count) in zip(histogram.buckets + (float('inf'),), histogram.counts):
+            cumulative += count
+            labels = format_labels(method=method, route=route, le=format_value(bucket))
+            lines.append(f'{name}_bucket{labels} {cumulative}')
+        labels = format_labels(method=method, route=route)
+        lines.append(f'{name}_sum{labels} {format_value(histogram.sum)}')
+        lines.append(f'{name}_count{labels} {histogram.count}')
+
+
+#----------------------------------------------------------------------------#
+# SQL statements.
+#----------------------------------------------------------------------------#
+
+# Counts the statements of every engine while a request started counting
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_sql_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context() and 'sql_statements' in g:
+        g.sql_statements += 1
@@ -0,0 +1,81 @@
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+
+# QueuePool that also measures how long checkouts wait for a connection, so
+# pools can be sized from /health instead of guessed
+class MeasuredQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            wait_time = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.timeouts += timed_out
+                self.wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+
+
+# Returns the create_engine options of a database uri from the DATABASE_*
+# settings of a flask config
+def engine_options(config, uri):
+    url = make_url(uri)
+    options = {
+        'poolclass': MeasuredQueuePool,
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        'pool_pre_ping': config['DATABASE_POOL_PRE_PING']
+    }
+
+    if url.get_backend_name() == 'postgresql' and config['DATABASE_STATEMENT_TIMEOUT']:
+        options['connect_args'] = {'options': f"-c statement_timeout={int(config['DATABASE_STATEMENT_TIMEOUT'])}"}
+    elif url.get_backend_name() == 'sqlite':
+        # pooled connections are handed to whichever thread checks them out
+        options['connect_args'] = {'check_same_thread': False}
+
+    return options
+
+
+def pool_stats(pool):
+    stats = {'class': type(pool).__name__}
+
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'max_overflow': pool._max_overflow,
+            'timeout': pool.timeout()
+        })
+
+    if isinstance(pool, MeasuredQueuePool):
+        with pool._stats_lock:
+            stats.update({
+                'checkouts': pool.checkouts,
+                'timeouts': pool.timeouts,
+                'wait_time_ms': round(pool.wait_time * 1000, 3),
+                'max_wait_time_ms': round(pool.max_wait_time * 1000, 3)
+            })
+
+    return stats
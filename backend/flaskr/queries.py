@@ -0,0 +1,88 @@
+import base64
+import binascii
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import func
+
+from .models import db, Question
+
+QUIZ_RANDOM_MODES = ('range', 'order')
+
+
+# Returns a random question of questions_query whose id isn't in `excluded`
+def random_question(questions_query, excluded=(), mode='range'):
+    # range: pick a random id between the first and last id of questions_query,
+    #        read from the ends of its index, and take the first question not
+    #        excluded at or after it, wrapping around. Only the probes filter
+    #        out excluded ids so every query reads a few index entries.
+    # order: ORDER BY random() LIMIT 1 over the candidates, reads them all
+    candidates = questions_query.filter(~Question.id.in_(excluded)) if excluded else questions_query
+
+    if mode == 'range':
+        ids = questions_query.with_entities(Question.id)
+        (low, high) = db.session.query(
+            ids.order_by(Question.id).limit(1).scalar_subquery(),
+            ids.order_by(Question.id.desc()).limit(1).scalar_subquery()
+        ).one()
+        if low is None:
+            return None
+
+        pivot = random.randint(low, high)
+        question = candidates.filter(Question.id >= pivot).order_by(Question.id).first()
+        if question is None:
+            question = candidates.filter(Question.id < pivot).order_by(Question.id).first()
+        return question
+
+    return candidates.order_by(func.random()).first()
+
+
+def encode_cursor(question_id):
+    return base64.urlsafe_b64encode(json.dumps({'id': question_id}).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        question_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))['id']
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise ValueError(f'invalid cursor {cursor}')
+
+    if not isinstance(question_id, int):
+        raise ValueError(f'invalid cursor {cursor}')
+    return question_id
+
+
+# Small LRU cache of query counts that expire after `ttl` seconds, used where
+# an approximate total is good enough (e.g. search results).
+class CountCache:
+    def __init__(self, ttl=60, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, count):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._counts.move_to_end(key)
+                return entry[0]
+
+        value = count()
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._counts[key] = (value, time.monotonic())
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
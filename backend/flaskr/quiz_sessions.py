@@ -0,0 +1,74 @@
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class QuizSession:
+    def __init__(self, category_id, deck):
+        self.category_id = category_id
+        self.deck = deck
+        self.touched = time.monotonic()
+
+    def next_question_id(self):
+        return self.deck.pop() if self.deck else None
+
+    # The next `count` ids of the deck in dealing order, without dealing them
+    def peek(self, count):
+        return self.deck[:-count - 1:-1]
+
+    def remaining(self):
+        return len(self.deck)
+
+
+# In-memory store of quiz sessions, each holding a shuffled deck of question
+# ids that is built once and then popped one id per call. Sessions expire after
+# `ttl` seconds of inactivity and the least recently used one is evicted once
+# the store holds `max_sessions`. The store lives in the memory of one process,
+# a session is only found by the worker that created it.
+class QuizSessionStore:
+    def __init__(self, ttl=3600, max_sessions=10000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, category_id, question_ids):
+        deck = list(question_ids)
+        random.shuffle(deck)
+
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self._expire(time.monotonic())
+            while len(self._sessions) >= self.max_sessions:
+                self._sessions.popitem(last=False)
+            self._sessions[session_id] = QuizSession(category_id, deck)
+
+        return session_id
+
+    def get(self, session_id):
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.touched = now
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _expire(self, now):
+        # sessions are ordered by last use so expired ones are at the front
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.touched < self.ttl:
+                break
+            del self._sessions[session_id]
@@ -0,0 +1,82 @@
+import threading
+import time
+import weakref
+
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .models import db, Category, mark_categories_changed
+
+# every registry of this process, invalidated when a commit changes categories
+registries = weakref.WeakSet()
+
+
+# In-memory copy of the category ids and types so validators and category
+# endpoints don't query the database for them (question counts change with
+# every question write and are read from the database). It loads on first use
+# and reloads after a local commit changes categories, or when `ttl` seconds
+# have passed (0 never expires). `publish` is called after local
+# invalidations so other processes can be told to call invalidate().
+class CategoryRegistry:
+    def __init__(self, ttl=0, publish=None):
+        self.ttl = ttl
+        self.publish = publish
+        self._categories = None
+        self._loaded = 0
+        self._lock = threading.Lock()
+        registries.add(self)
+
+    def categories(self):
+        return list(self._snapshot().values())
+
+    def get(self, category_id):
+        return self._snapshot().get(category_id)
+
+    def exists(self, category_id):
+        return category_id in self._snapshot()
+
+    def invalidate(self, publish=False):
+        with self._lock:
+            self._categories = None
+
+        if publish and self.publish:
+            self.publish()
+
+    def _snapshot(self):
+        with self._lock:
+            categories = self._categories
+            if categories is not None and self.ttl and time.monotonic() - self._loaded >= self.ttl:
+                categories = None
+
+            if categories is None:
+                categories_query = db.session.query(Category.id, Category.type).order_by(Category.id)
+                categories = {category_id: {'id': category_id, 'type': type} for (category_id, type) in categories_query}
+                self._categories = categories
+                self._loaded = time.monotonic()
+
+                # reloads can land on any request, query budgets leave them out
+                if has_app_context() and 'sql_statements' in g:
+                    g.registry_statements = g.get('registry_statements', 0) + 1
+
+            return categories
+
+
+@event.listens_for(Session, 'after_flush')
+def track_category_changes(session, flush_context):
+    for objs in (session.new, session.dirty, session.deleted):
+        if any(isinstance(obj, Category) for obj in objs):
+            mark_categories_changed(session)
+            return
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_registries_after_commit(session):
+    if session.info.pop('categories_changed', False):
+        for registry in list(registries):
+            registry.invalidate(publish=True)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_category_changes(session, previous_transaction):
+    session.info.pop('categories_changed', None)
@@ -0,0 +1,72 @@
+import threading
+import time
+
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+from .pool import pool_stats
+
+
+# Hands out replica engines round-robin. A replica a read failed on is marked
+# down and skipped for `retry` seconds, None is returned when every replica is
+# down so the caller falls back to the primary.
+class ReplicaRouter:
+    def __init__(self, engines, retry=30):
+        self.engines = list(engines)
+        self.retry = retry
+        self.reads = [0] * len(self.engines)
+        self._next = 0
+        self._down = {}
+        self._lock = threading.Lock()
+
+    def engine(self):
+        with self._lock:
+            for _ in range(len(self.engines)):
+                index = self._next
+                self._next = (self._next + 1) % len(self.engines)
+                if self._down.get(index, 0) > time.monotonic():
+                    continue
+
+                self._down.pop(index, None)
+                self.reads[index] += 1
+                return self.engines[index]
+
+        return None
+
+    def mark_down(self, engine):
+        index = self.engines.index(engine)
+        with self._lock:
+            self._down[index] = time.monotonic() + self.retry
+            self.reads[index] -= 1
+
+    def stats(self):
+        with self._lock:
+            return [{
+                'url': repr(engine.url),
+                'available': self._down.get(index, 0) <= time.monotonic(),
+                'reads': self.reads[index],
+                'pool': pool_stats(engine.pool)
+            } for (index, engine) in enumerate(self.engines)]
+
+
+# Session that sends reads to the replica picked for the current request.
+# Flushes and INSERT/UPDATE/DELETE statements always go to the primary, and
+# once the session wrote, its later reads do too.
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        engine = g.get('read_engine') if has_app_context() else None
+        if engine is None:
+            return super().get_bind(mapper, clause)
+
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        if self.info.get('wrote'):
+            return super().get_bind(mapper, clause)
+        return engine
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
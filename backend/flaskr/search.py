@@ -0,0 +1,248 @@
+import re
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+from sqlalchemy import DDL, Column, Float, Integer, MetaData, String, Table, event, func, literal_column, select, text
+
+from .models import db, Question
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+SEARCH_BACKENDS = ('fulltext', 'like')
+MAX_REGEX_LENGTH = 100
+MAX_REGEX_BRANCHING = 1000
+MAX_REGEX_STEPS = 10 ** 7
+
+#----------------------------------------------------------------------------#
+# Search indexes.
+#----------------------------------------------------------------------------#
+
+# PostgreSQL: a generated tsvector column with a GIN index, kept in sync by
+# the database on every insert and update of questions.question
+postgresql_search_index = [
+    DDL("ALTER TABLE questions ADD COLUMN IF NOT EXISTS search_vector tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(question, ''))) STORED"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_questions_search_vector ON questions USING GIN (search_vector)")
+]
+
+# SQLite: an external content FTS5 table kept in sync by triggers
+sqlite_search_index = [
+    DDL("CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(question, content='questions', content_rowid='id')"),
+    DDL("CREATE TRIGGER IF NOT EXISTS questions_fts_insert AFTER INSERT ON questions BEGIN "
+        "INSERT INTO questions_fts(rowid, question) VALUES (new.id, new.question); END"),
+    DDL("CREATE TRIGGER IF NOT EXISTS questions_fts_delete AFTER DELETE ON questions BEGIN "
+        "INSERT INTO questions_fts(questions_fts, rowid, question) VALUES ('delete', old.id, old.question); END"),
+    DDL("CREATE TRIGGER IF NOT EXISTS questions_fts_update AFTER UPDATE OF question ON questions BEGIN "
+        "INSERT INTO questions_fts(questions_fts, rowid, question) VALUES ('delete', old.id, old.question); "
+        "INSERT INTO questions_fts(rowid, question) VALUES (new.id, new.question); END"),
+    DDL("INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')")
+]
+
+# not part of db.metadata so create_all and drop_all leave it to the DDL above
+questions_fts = Table(
+    'questions_fts', MetaData(),
+    Column('rowid', Integer),
+    Column('question', String),
+    Column('rank', Float)
+)
+
+for ddl in postgresql_search_index:
+    event.listen(Question.__table__, 'after_create', ddl.execute_if(dialect='postgresql'))
+for ddl in sqlite_search_index:
+    event.listen(Question.__table__, 'after_create', ddl.execute_if(dialect='sqlite'))
+event.listen(Question.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS questions_fts').execute_if(dialect='sqlite'))
+
+
+def create_search_index():
+    # for databases created before the search index existed
+    ddls = {
+        'postgresql': postgresql_search_index,
+        'sqlite': sqlite_search_index
+    }.get(db.engine.dialect.name, [])
+
+    with db.engine.begin() as connection:
+        for ddl in ddls:
+            connection.execute(ddl)
+
+#----------------------------------------------------------------------------#
+# Search queries.
+#----------------------------------------------------------------------------#
+
+
+def search_terms(search_term):
+    return re.findall(r'\w+', search_term.lower())
+
+
+# Returns (questions_query, rank) matching questions that contain words
+# starting with every word of the search term. rank orders best matches first
+# and is None when the like backend is used, or on SQLite unless `ranked`.
+def search_questions_query(questions_query, search_term, backend='fulltext', ranked=False):
+    terms = search_terms(search_term)
+    dialect = db.engine.dialect.name
+
+    if backend == 'fulltext' and terms and dialect == 'postgresql':
+        tsquery = func.to_tsquery('simple', ' & '.join(f'{term}:*' for term in terms))
+        search_vector = literal_column('questions.search_vector')
+
+        questions_query = questions_query.filter(search_vector.op('@@')(tsquery))
+        return (questions_query, func.ts_rank(search_vector, tsquery).desc())
+
+    if backend == 'fulltext' and terms and dialect == 'sqlite':
+        match = questions_fts.c.question.op('MATCH')(' '.join(f'"{term}"*' for term in terms))
+
+        # the matches are read once by a rowid IN (...) sub-select so the FTS
+        # index drives the search, joined to questions_fts SQLite may rather
+        # walk another index (e.g. of the category) and probe it once per row
+        questions_query = questions_query.filter(Question.id.in_(select(questions_fts.c.rowid).where(match)))
+        if not ranked:
+            return (questions_query, None)
+
+        # the rank of a match is only read through a join
+        questions_query = questions_query.join(questions_fts, questions_fts.c.rowid == Question.id).filter(match)
+        return (questions_query, questions_fts.c.rank)
+
+    return (questions_query.filter(Question.question.ilike(f'%{escape_like(search_term)}%', escape='\\')), None)
+
+
+def escape_like(search_term):
+    return search_term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# Returns a questions query matching a case insensitive regex, rejecting
+# patterns that are too long, invalid or that backtrack too much with a
+# ValueError: repeating a group holding another quantifier or alternatives
+# (e.g. (a+)+ or (a|a)*), more than one unbounded quantifier (e.g. .*.*x) or
+# more than MAX_REGEX_BRANCHING ways for the bounded quantifiers and
+# alternatives to match. What is left costs at most about
+# len(question) ** (1 + unbounded) * branching steps per question.
+def regex_questions_query(questions_query, pattern):
+    if len(pattern) > MAX_REGEX_LENGTH:
+        raise ValueError(f'regex is longer than {MAX_REGEX_LENGTH} characters')
+
+    pattern = f'(?i){pattern}'
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        raise ValueError('regex is not valid')
+
+    if repeats_backtracking(parsed):
+        raise ValueError('regex must not repeat a group holding quantifiers or alternatives')
+
+    (unbounded, branching) = backtracking(parsed)
+    if unbounded > 1:
+        raise ValueError('regex must not have more than one unbounded quantifier')
+    if branching > MAX_REGEX_BRANCHING:
+        raise ValueError(f'regex quantifiers and alternatives must not match in more than {MAX_REGEX_BRANCHING} ways')
+
+    return questions_query.filter(Question.question.regexp_match(pattern))
+
+
+def repeats_backtracking(subpattern, repeated=False):
+    for (op, av) in subpattern:
+        repeat = op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+        if repeated and (repeat or op == sre_parse.BRANCH):
+            return True
+
+        repeated_child = repeated or (repeat and av[1] > 1)
+        if any(repeats_backtracking(child, repeated_child) for child in subpatterns(av)):
+            return True
+    return False
+
+
+# Returns (unbounded, branching) of a parsed pattern, its number of unbounded
+# quantifiers and the number of ways its bounded quantifiers and alternatives
+# can match
+def backtracking(subpattern):
+    unbounded = 0
+    branching = 1
+    for (op, av) in subpattern:
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            if av[1] == sre_parse.MAXREPEAT:
+                unbounded += 1
+            else:
+                branching *= av[1] - av[0] + 1
+        elif op == sre_parse.BRANCH:
+            branching *= len(av[1])
+
+        for child in subpatterns(av):
+            (child_unbounded, child_branching) = backtracking(child)
+            unbounded += child_unbounded
+            branching *= child_branching
+    return (unbounded, branching)
+
+
+@lru_cache(maxsize=128)
+def pattern_backtracking(pattern):
+    return backtracking(sre_parse.parse(pattern))
+
+
+# The subpatterns of an item of a parsed pattern (groups, branches, lookarounds
+# and repeats)
+def subpatterns(av):
+    for item in (av if isinstance(av, (tuple, list)) else (av,)):
+        if isinstance(item, sre_parse.SubPattern):
+            yield item
+        elif isinstance(item, list):
+            yield from (child for child in item if isinstance(child, sre_parse.SubPattern))
+
+
+# REGEXP function of SQLite connections, like SQLAlchemy's
+def regexp(pattern, value):
+    if value is None:
+        return None
+    return re.search(pattern, value) is not None
+
+
+class RegexTimeout(Exception):
+    pass
+
+
+# REGEXP function of a SQLite regex search with a deadline. Python's re can't
+# be interrupted while it matches a question, so a question is refused before
+# it is matched once the deadline passed or when the pattern could backtrack
+# more than MAX_REGEX_STEPS on it.
+def bounded_regexp(deadline):
+    def bounded(pattern, value):
+        if value is None:
+            return None
+
+        (unbounded, branching) = pattern_backtracking(pattern)
+        if time.monotonic() > deadline or (len(value) + 1) ** (1 + unbounded) * branching > MAX_REGEX_STEPS:
+            raise RegexTimeout()
+        return re.search(pattern, value) is not None
+
+    return bounded
+
+
+# Bounds the statements of a regex search to `timeout` milliseconds, with
+# statement_timeout on PostgreSQL and bounded_regexp on SQLite
+@contextmanager
+def regex_timeout(timeout):
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        if timeout:
+            db.session.execute(text(f'SET LOCAL statement_timeout = {int(timeout)}'))
+        yield
+    elif dialect == 'sqlite':
+        connection = db.session.connection().connection
+        deadline = time.monotonic() + timeout / 1000 if timeout else float('inf')
+        connection.create_function('regexp', 2, bounded_regexp(deadline))
+        try:
+            yield
+        finally:
+            connection.create_function('regexp', 2, regexp)
+    else:
+        yield
+
+
+# Tells a regex search cancelled by regex_timeout from the database rejecting
+# the pattern, e.g. a Python only construct PostgreSQL doesn't support. On
+# SQLite the pattern is checked before the search, so only bounded_regexp
+# raises.
+def regex_timed_out(error):
+    return getattr(error.orig, 'pgcode', None) == '57014' or \
+        'user-defined function raised exception' in str(error.orig)
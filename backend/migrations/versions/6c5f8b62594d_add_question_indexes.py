@@ -0,0 +1,30 @@
+"""add question indexes
+
+Revision ID: 6c5f8b62594d
+Revises: ef3a131daba5
+Create Date: 2026-10-17 21:27:52.573865
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6c5f8b62594d'
+down_revision = 'ef3a131daba5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # built CONCURRENTLY on PostgreSQL so a populated questions table stays
+    # writable, which has to run outside the migration transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_questions_category_id_id', 'questions', ['category_id', 'id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_questions_category_id_difficulty', 'questions', ['category_id', 'difficulty'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_questions_category_id_difficulty', table_name='questions', postgresql_concurrently=True)
+        op.drop_index('ix_questions_category_id_id', table_name='questions', postgresql_concurrently=True)
@@ -0,0 +1,62 @@
+"""add search index
+
+Revision ID: ef3a131daba5
+Revises: b7f0f7e4de81
+Create Date: 2026-10-17 21:27:52.107738
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ef3a131daba5'
+down_revision = 'b7f0f7e4de81'
+branch_labels = None
+depends_on = None
+
+# full-text search index, see flaskr/search.py
+SEARCH_INDEX = {
+    'postgresql': [
+        "ALTER TABLE questions ADD COLUMN search_vector tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(question, ''))) STORED",
+        "CREATE INDEX ix_questions_search_vector ON questions USING GIN (search_vector)"
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE questions_fts USING fts5(question, content='questions', content_rowid='id')",
+        "CREATE TRIGGER questions_fts_insert AFTER INSERT ON questions BEGIN "
+        "INSERT INTO questions_fts(rowid, question) VALUES (new.id, new.question); END",
+        "CREATE TRIGGER questions_fts_delete AFTER DELETE ON questions BEGIN "
+        "INSERT INTO questions_fts(questions_fts, rowid, question) VALUES ('delete', old.id, old.question); END",
+        "CREATE TRIGGER questions_fts_update AFTER UPDATE OF question ON questions BEGIN "
+        "INSERT INTO questions_fts(questions_fts, rowid, question) VALUES ('delete', old.id, old.question); "
+        "INSERT INTO questions_fts(rowid, question) VALUES (new.id, new.question); END",
+        # index the existing questions
+        "INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')"
+    ]
+}
+
+DROP_SEARCH_INDEX = {
+    'postgresql': [
+        "DROP INDEX ix_questions_search_vector",
+        "ALTER TABLE questions DROP COLUMN search_vector"
+    ],
+    'sqlite': [
+        "DROP TRIGGER questions_fts_update",
+        "DROP TRIGGER questions_fts_delete",
+        "DROP TRIGGER questions_fts_insert",
+        "DROP TABLE questions_fts"
+    ]
+}
+
+
+def upgrade():
+    dialect = op.get_context().dialect.name
+    for statement in SEARCH_INDEX.get(dialect, []):
+        op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_context().dialect.name
+    for statement in DROP_SEARCH_INDEX.get(dialect, []):
+        op.execute(statement)
@@ -1,17 +1,25 @@
 import os
+import re
 import unittest
 import json
 
+from flask import g
 from flask_sqlalchemy import SQLAlchemy
 from schema import Schema, And, Use, Optional, SchemaError
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
 
 from flaskr import create_app
-from flaskr.models import setup_db, db, Question, Category
+from flaskr.budgets import QueryBudgetExceeded, query_budget
+from flaskr.bulk import copy_csv
+from flaskr.encoding import json_provider
+from flaskr.generator import generate_questions, write_questions
+from flaskr.models import setup_db, db, Question, Category, database_path, recount_questions
 
 
 class TriviaTestCase(unittest.TestCase):
     def setUp(self):
-        self.app = create_app()
+        self.app = create_app({'TESTING': True})
         self.client = self.app.test_client
         setup_db(self.app, 'trivia_test')
 
@@ -55,7 +63,8 @@ class TriviaTestCase(unittest.TestCase):
             'question': str,
             'answer': str,
             'difficulty': int,
-            'category': int
+            'category': int,
+            'version': int
         })
 
         res = self.client().post('/questions', json={
@@ -113,6 +122,127 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(description, 'input question was bad or not formatted correctly')
         self.assertEqual(message, 'bad request')
 
+    #  Import questions
+    #  ----------------------------------------------------------------
+
+    def test_import_questions_ndjson_success(self):
+        lines = [
+            json.dumps({'question': 'Who are you?', 'answer': 'Someone', 'difficulty': 5, 'category': 1}),
+            json.dumps({'question': 'Who is she?', 'answer': 'Someone else', 'difficulty': 2, 'category': 8}),
+            'sadsadsad',
+            json.dumps({'question': 'Who is he?', 'answer': 'No one', 'difficulty': '3', 'category': 1})
+        ]
+
+        res = self.client().post('/questions/bulk', data='\n'.join(lines), content_type='application/x-ndjson')
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual([error['line'] for error in data['errors']], [2, 3])
+
+        # check imported questions
+        data = json.loads(self.client().get('/categories/1/questions').data)
+        self.assertEqual([question['question'] for question in data['questions']], [
+            'What is the heaviest organ in the human body?', 'Who are you?', 'Who is he?'
+        ])
+        self.assertEqual(data['category']['total_questions'], 3)
+
+        data = json.loads(self.client().post('/questions', json={'search_term': 'who is he'}).data)
+        self.assertEqual([question['question'] for question in data['questions']], ['Who is he?'])
+
+    def test_import_questions_empty_values(self):
+        line = json.dumps({'question': 'Who are you?', 'answer': '', 'difficulty': 5, 'category': 1})
+
+        res = self.client().post('/questions/bulk', data=line, content_type='application/x-ndjson')
+
+        # check the empty answer is imported as an empty string
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['inserted'], 1)
+        data = json.loads(self.client().get('/categories/1/questions').data)
+        self.assertEqual([question['answer'] for question in data['questions']], ['The Liver', ''])
+
+        # check COPY gets the empty values quoted, unquoted ones would load as NULL
+        buffer = copy_csv([{'question': '', 'answer': '', 'difficulty': 1, 'category_id': 1}])
+        self.assertEqual(buffer.getvalue(), '"","","1","1"\r\n')
+
+    def test_import_questions_csv_success(self):
+        content = 'question,answer,difficulty,category\n' \
+            '"Who are you, really?",Someone,5,1\n' \
+            'Who is she?,Someone else,9,1\n'
+
+        res = self.client().post('/questions/bulk', data=content, content_type='text/csv')
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 200)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['failed'], 1)
+        self.assertEqual(data['errors'][0]['line'], 3)
+
+        # check imported question
+        data = json.loads(self.client().get('/questions/6').data)
+        self.assertEqual(data['question']['question'], 'Who are you, really?')
+
+    def test_import_questions_fail_bad_format(self):
+        res = self.client().post('/questions/bulk', data='sadsadsad', content_type='text/plain')
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['description'], 'bulk import expects one of application/x-ndjson, application/jsonl, text/csv')
+
+    #  Export questions
+    #  ----------------------------------------------------------------
+
+    def test_export_questions_ndjson_success(self):
+        expected_questions = [question.format() for question in self.temp_questions]
+
+        res = self.client().get('/questions/export')
+
+        # check status and data
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in res.data.decode().splitlines()], expected_questions)
+
+    def test_export_questions_csv_filtered_success(self):
+        res = self.client().get('/questions/export?format=csv&category=4&difficulty=1')
+
+        # check status and data
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        self.assertEqual(res.data.decode().splitlines(), [
+            'id,question,answer,difficulty,category,version',
+            '2,What boxer\'s original name is Cassius Clay?,Muhammad Ali,1,4,1'
+        ])
+
+    def test_export_questions_reimport(self):
+        content = self.client().get('/questions/export?format=csv').data
+
+        data = json.loads(self.client().post('/questions/bulk', data=content, content_type='text/csv').data)
+        self.assertEqual(data['inserted'], 5)
+        self.assertEqual(data['failed'], 0)
+
+    def test_export_questions_fail_bad_format(self):
+        res = self.client().get('/questions/export?format=xml')
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['description'], 'export format must be one of ndjson, csv')
+
     #  Get questions
     #  ----------------------------------------------------------------
 
@@ -122,9 +252,12 @@ class TriviaTestCase(unittest.TestCase):
             'question': str,
             'answer': str,
             'difficulty': int,
-            'category': int
+            'category': int,
+            'version': int
         })
 
+        expected_questions = [question.format() for question in self.temp_questions]
+
         res = self.client().get('/questions')
 
         status = res.status_code
@@ -144,7 +277,27 @@ class TriviaTestCase(unittest.TestCase):
         for i in range(len(questions)):
             question = questions[i]
             self.assertTrue(schema.is_valid(question))
-            self.assertEqual(question, self.temp_questions[i].format())
+            self.assertEqual(question, expected_questions[i])
+
+    def test_get_questions_skips_question_instances(self):
+        loaded = []
+        listener = lambda question, context: loaded.append(question)
+        event.listen(Question, 'load', listener)
+        try:
+            responses = [
+                self.client().get('/questions'),
+                self.client().get('/questions?page=1&per_page=2'),
+                self.client().get('/questions?after_id=2'),
+                self.client().post('/questions', json={'search_term': 'what'}),
+                self.client().get('/categories/4/questions'),
+                self.client().post('/categories/4/questions', json={'search_term': 'what'})
+            ]
+        finally:
+            event.remove(Question, 'load', listener)
+
+        # check questions were listed from rows, not Question instances
+        self.assertEqual([res.status_code for res in responses], [200] * len(responses))
+        self.assertEqual(loaded, [])
 
     def test_get_questions_fail_no_questions(self):
         db.drop_all()
@@ -168,13 +321,98 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['description'], 'no questions found')
         self.assertEqual(data['message'], 'not found')
 
+    def test_get_questions_cursor_success(self):
+        expected_questions = [question.format() for question in self.temp_questions]
+
+        # walk all questions two at a time
+        questions = []
+        res = self.client().get('/questions?after_id=0&per_page=2')
+        while True:
+            status = res.status_code
+            data = json.loads(res.data)
+
+            # check status and data
+            self.assertEqual(status, 200)
+            self.assertTrue('next_cursor' in data)
+            self.assertEqual(data['total_questions'], 5)
+            self.assertTrue(len(data['questions']) <= 2)
+
+            questions += data['questions']
+            if data['next_cursor'] is None:
+                break
+            res = self.client().get(f"/questions?cursor={data['next_cursor']}&per_page=2")
+
+        self.assertEqual(questions, expected_questions)
+
+    def test_get_questions_page_next_cursor(self):
+        data = json.loads(self.client().get('/questions?page=1&per_page=3').data)
+        self.assertEqual(len(data['questions']), 3)
+
+        data = json.loads(self.client().get(f"/questions?cursor={data['next_cursor']}&per_page=3").data)
+        self.assertEqual([question['id'] for question in data['questions']], [4, 5])
+        self.assertEqual(data['next_cursor'], None)
+
+    def test_get_questions_fail_bad_cursor(self):
+        res = self.client().get('/questions?cursor=sadsadsad')
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['error'], 400)
+        self.assertEqual(data['description'], 'invalid cursor sadsadsad')
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_get_questions_fail_bad_per_page(self):
+        res = self.client().get('/questions?page=1&per_page=0')
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['description'], 'per_page must be a positive number')
+
+    def test_get_questions_total_follows_writes(self):
+        self.client().post('/questions', json={
+            'question': 'Who are you?',
+            'answer': 'Someone',
+            'difficulty': 5,
+            'category': 1
+        })
+        self.client().delete('/questions/2')
+        self.client().patch('/questions/1', json={
+            'category': 1
+        })
+
+        # check global total
+        data = json.loads(self.client().get('/questions?page=1').data)
+        self.assertEqual(data['total_questions'], 5)
+
+        # check category totals
+        data = json.loads(self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': 1
+        }).data)
+        self.assertEqual(data['total_questions'], 3)
+
+        data = json.loads(self.client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': 4
+        }).data)
+        self.assertEqual(data['total_questions'], 0)
+
     def test_get_question_success(self):
         schema = Schema({
             'id': int,
             'question': str,
             'answer': str,
             'difficulty': int,
-            'category': int
+            'category': int,
+            'version': int
         })
 
         res = self.client().get('/questions/1')
@@ -223,9 +461,12 @@ class TriviaTestCase(unittest.TestCase):
             'question': str,
             'answer': str,
             'difficulty': int,
-            'category': int
+            'category': int,
+            'version': int
         })
 
+        expected_questions = [question.format() for question in self.temp_questions]
+
         res = self.client().post('/questions', json={
             'search_term': 'what'
         })
@@ -250,9 +491,91 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(search_term, 'what')
         self.assertEqual(total_questions, 2)
         self.assertTrue(schema.is_valid(questions[0]))
-        self.assertEqual(questions[0], self.temp_questions[1].format())
+        self.assertEqual(questions[0], expected_questions[1])
         self.assertTrue(schema.is_valid(questions[1]))
-        self.assertEqual(questions[1], self.temp_questions[4].format())
+        self.assertEqual(questions[1], expected_questions[4])
+
+    def test_search_question_ranked_success(self):
+        expected_questions = [question.format() for question in self.temp_questions]
+
+        res = self.client().post('/questions?order=rank', json={
+            'search_term': 'the human'
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], 1)
+        self.assertEqual(data['questions'][0], expected_questions[4])
+
+    def test_search_question_follows_edits(self):
+        self.client().patch('/questions/2', json={
+            'question': 'Who was Cassius Clay?'
+        })
+
+        data = json.loads(self.client().post('/questions', json={
+            'search_term': 'what'
+        }).data)
+        self.assertEqual([question['id'] for question in data['questions']], [5])
+
+        data = json.loads(self.client().post('/questions', json={
+            'search_term': 'cassius'
+        }).data)
+        self.assertEqual([question['id'] for question in data['questions']], [2])
+
+    def test_search_question_fail_bad_order(self):
+        res = self.client().post('/questions?order=sad', json={
+            'search_term': 'what'
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['description'], "order must be either 'id' or 'rank'")
+
+    def test_search_question_fail_bad_search_term(self):
+        for search_term in [5, ['what'], None]:
+            res = self.client().post('/questions', json={
+                'search_term': search_term
+            })
+
+            status = res.status_code
+            data = json.loads(res.data)
+
+            # check status and data
+            self.assertEqual(status, 400, search_term)
+            self.assertFalse(data['success'])
+            self.assertEqual(data['description'], 'search term must be a string')
+
+    def test_search_question_exact_count(self):
+        data = json.loads(self.client().post('/questions?page=1', json={
+            'search_term': 'what'
+        }).data)
+        self.assertEqual(data['total_questions'], 2)
+
+        self.client().post('/questions', json={
+            'question': 'What are you?',
+            'answer': 'Something',
+            'difficulty': 5,
+            'category': 1
+        })
+
+        # cached total until an exact count is asked for
+        data = json.loads(self.client().post('/questions?page=1', json={
+            'search_term': 'what'
+        }).data)
+        self.assertEqual(data['total_questions'], 2)
+
+        data = json.loads(self.client().post('/questions?page=1&exact_count=true', json={
+            'search_term': 'what'
+        }).data)
+        self.assertEqual(data['total_questions'], 3)
 
     def test_search_question_fail_no_questions(self):
         res = self.client().post('/questions', json={
@@ -284,7 +607,8 @@ class TriviaTestCase(unittest.TestCase):
             'question': str,
             'answer': str,
             'difficulty': int,
-            'category': int
+            'category': int,
+            'version': int
         })
 
         res = self.client().put('/questions/1', json={
@@ -370,9 +694,12 @@ class TriviaTestCase(unittest.TestCase):
             'question': str,
             'answer': str,
             'difficulty': int,
-            'category': int
+            'category': int,
+            'version': int
         })
 
+        expected_question = self.temp_questions[0].format()
+
         res = self.client().patch('/questions/1', json={
             'question': 'Who are you?',
             'category': 1
@@ -395,8 +722,8 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(schema.is_valid(question))
         self.assertEqual(question['id'], 1)
         self.assertEqual(question['question'], 'Who are you?')
-        self.assertEqual(question['answer'], self.temp_questions[0].answer)
-        self.assertEqual(question['difficulty'], self.temp_questions[0].difficulty)
+        self.assertEqual(question['answer'], expected_question['answer'])
+        self.assertEqual(question['difficulty'], expected_question['difficulty'])
         self.assertEqual(question['category'], 1)
 
         # check edited question
@@ -450,15 +777,92 @@ class TriviaTestCase(unittest.TestCase):
     #  Delete questions
     #  ----------------------------------------------------------------
 
+    def test_edit_question_with_version_success(self):
+        res = self.client().patch('/questions/1', json={
+            'answer': 'Someone',
+            'version': 1
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 200)
+        self.assertEqual(data['question']['answer'], 'Someone')
+        self.assertEqual(data['question']['version'], 2)
+
+        res = self.client().put('/questions/1', headers={'If-Match': '"2"'}, json={
+            'question': 'Who are you?',
+            'answer': 'Someone',
+            'difficulty': 5,
+            'category': 1
+        })
+
+        # check the If-Match edit
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['question']['version'], 3)
+
+    def test_edit_question_with_version_fail_conflict(self):
+        self.client().patch('/questions/1', json={
+            'answer': 'Someone'
+        })
+
+        res = self.client().patch('/questions/1', headers={'If-Match': '"1"'}, json={
+            'answer': 'Someone else'
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 409)
+        self.assertTrue('success' in data)
+        self.assertTrue('error' in data)
+        self.assertTrue('description' in data)
+        self.assertTrue('message' in data)
+
+        # check success
+        self.assertFalse(data['success'])
+        self.assertEqual(data['error'], 409)
+        self.assertEqual(data['description'], 'question 1 was edited since version 1')
+        self.assertEqual(data['message'], 'conflict')
+
+        # check the question kept the first edit
+        question = json.loads(self.client().get('/questions/1').data)['question']
+        self.assertEqual(question['answer'], 'Someone')
+        self.assertEqual(question['version'], 2)
+
+    def test_edit_question_with_version_fail_bad_input(self):
+        res = self.client().patch('/questions/1', headers={'If-Match': '"1", "2"'}, json={
+            'answer': 'Someone'
+        })
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(json.loads(res.data)['description'], 'If-Match must be a single question version')
+
+        res = self.client().patch('/questions/1', headers={'If-Match': '"1"'}, json={
+            'answer': 'Someone',
+            'version': 2
+        })
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client().patch('/questions/6', json={
+            'answer': 'Someone',
+            'version': 1
+        })
+        self.assertEqual(res.status_code, 422)
+
     def test_delete_question_success(self):
         schema = Schema({
             'id': int,
             'question': str,
             'answer': str,
             'difficulty': int,
-            'category': int
+            'category': int,
+            'version': int
         })
 
+        expected_question = self.temp_questions[0].format()
+
         res = self.client().delete('/questions/1')
 
         status = res.status_code
@@ -475,7 +879,7 @@ class TriviaTestCase(unittest.TestCase):
         # check question
         question = data['question']
         self.assertTrue(schema.is_valid(question))
-        self.assertEqual(question, self.temp_questions[0].format())
+        self.assertEqual(question, expected_question)
 
     def test_delete_question_fail_no_question(self):
         res = self.client().delete('/questions/6')
@@ -563,6 +967,82 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(description, 'no json body was found')
         self.assertEqual(message, 'bad request')
 
+    #  Edit and delete many questions
+    #  ----------------------------------------------------------------
+
+    def test_edit_questions_in_bulk_success(self):
+        res = self.client().patch('/questions/bulk', json={
+            'filter': {'category': 4},
+            'values': {'category': 1, 'difficulty': 3}
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['questions'], [1, 2])
+        self.assertEqual(data['total_questions'], 2)
+
+        # check edited questions and counts
+        data = json.loads(self.client().get('/categories/1/questions').data)
+        self.assertEqual([question['id'] for question in data['questions']], [1, 2, 5])
+        self.assertEqual([question['difficulty'] for question in data['questions']], [3, 3, 4])
+        self.assertEqual(data['category']['total_questions'], 3)
+        self.assertEqual(json.loads(self.client().get('/categories/4').data)['category']['total_questions'], 0)
+
+    def test_edit_questions_in_bulk_fail_bad_input(self):
+        res = self.client().patch('/questions/bulk', json={
+            'ids': [1, 2],
+            'filter': {'category': 4},
+            'values': {'difficulty': 3}
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['description'], 'select questions with either ids or a non empty filter')
+
+        res = self.client().patch('/questions/bulk', json={
+            'ids': [1, 2],
+            'values': {'difficulty': 9}
+        })
+        self.assertEqual(res.status_code, 400)
+
+    def test_delete_questions_in_bulk_success(self):
+        res = self.client().delete('/questions/bulk', json={
+            'ids': [1, 3, 6]
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['questions'], [1, 3])
+
+        # check deleted questions and counts
+        data = json.loads(self.client().get('/questions?page=1').data)
+        self.assertEqual([question['id'] for question in data['questions']], [2, 4, 5])
+        self.assertEqual(data['total_questions'], 3)
+
+    def test_delete_questions_in_bulk_fail_empty_filter(self):
+        res = self.client().delete('/questions/bulk', json={
+            'filter': {}
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 400)
+        self.assertEqual(data['description'], 'select questions with either ids or a non empty filter')
+
     #----------------------------------------------------------------------------#
     # Categories.
     #----------------------------------------------------------------------------#
@@ -574,9 +1054,11 @@ class TriviaTestCase(unittest.TestCase):
         schema = Schema({
             'id': int,
             'type': str,
-            'questions': [int],
+            'total_questions': int,
         })
 
+        expected_categories = [category.format() for category in self.temp_categories]
+
         res = self.client().get('/categories')
 
         status = res.status_code
@@ -596,7 +1078,61 @@ class TriviaTestCase(unittest.TestCase):
         for i in range(len(categories)):
             category = categories[i]
             self.assertTrue(schema.is_valid(category))
-            self.assertEqual(category, self.temp_categories[i].format())
+            self.assertEqual(category, expected_categories[i])
+
+    def test_get_categories_question_ids_success(self):
+        schema = Schema({
+            'id': int,
+            'type': str,
+            'total_questions': int,
+            'questions': [int],
+        })
+
+        expected_question_ids = [sorted(question.id for question in category.questions) for category in self.temp_categories]
+
+        res = self.client().get('/categories?include=question_ids')
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 200)
+        self.assertEqual(data['success'], True)
+
+        # check categories
+        categories = data['categories']
+        for i in range(len(categories)):
+            category = categories[i]
+            self.assertTrue(schema.is_valid(category))
+            self.assertEqual(category['questions'], expected_question_ids[i])
+            self.assertEqual(category['total_questions'], len(category['questions']))
+
+    def test_get_categories_follows_writes(self):
+        published = []
+        app = create_app({'TESTING': True, 'CATEGORY_REGISTRY_PUBLISH': lambda: published.append(True)})
+        setup_db(app, 'trivia_test')
+        client = app.test_client
+
+        self.assertEqual(len(json.loads(client().get('/categories').data)['categories']), 6)
+
+        db.session.add(Category('Physics'))
+        db.session.commit()
+
+        # check new category is listed and other processes were told
+        categories = json.loads(client().get('/categories').data)['categories']
+        self.assertEqual(categories[6]['type'], 'Physics')
+        self.assertTrue(published)
+
+        client().post('/questions', json={
+            'question': 'Who are you?',
+            'answer': 'Someone',
+            'difficulty': 5,
+            'category': 7
+        })
+
+        # check new question is counted
+        category = json.loads(client().get('/categories/7').data)['category']
+        self.assertEqual(category['total_questions'], 1)
 
     def test_get_categories_fail_no_categories(self):
         db.drop_all()
@@ -624,9 +1160,11 @@ class TriviaTestCase(unittest.TestCase):
         schema = Schema({
             'id': int,
             'type': str,
-            'questions': [int],
+            'total_questions': int,
         })
 
+        expected_categories = [category.format() for category in self.temp_categories]
+
         res = self.client().get('/categories/1')
 
         status = res.status_code
@@ -643,7 +1181,7 @@ class TriviaTestCase(unittest.TestCase):
         # check category
         category = data['category']
         self.assertTrue(schema.is_valid(category))
-        self.assertEqual(category, self.temp_categories[0].format())
+        self.assertEqual(category, expected_categories[0])
 
     def test_get_category_fail_no_category(self):
         res = self.client().get('/categories/8')
@@ -664,6 +1202,33 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['description'], 'no category found with id 8')
         self.assertEqual(data['message'], 'not found')
 
+    def test_category_registry_survives_question_writes(self):
+        published = []
+        app = create_app({'TESTING': True, 'CATEGORY_REGISTRY_PUBLISH': lambda: published.append(True)})
+        setup_db(app, 'trivia_test')
+
+        for _ in range(2):
+            res = app.test_client().post('/questions', json={
+                'question': 'Who are you?',
+                'answer': 'Someone',
+                'difficulty': 5,
+                'category': 1
+            })
+            self.assertEqual(res.status_code, 200)
+        res = app.test_client().delete('/questions/5')
+        self.assertEqual(res.status_code, 200)
+
+        # check question writes didn't invalidate the registry, counts are still current
+        self.assertEqual(published, [])
+        data = json.loads(app.test_client().get('/categories/1').data)
+        self.assertEqual(data['category']['total_questions'], 2)
+
+        # check category writes do
+        db.session.add(Category('Music'))
+        db.session.commit()
+        self.assertEqual(published, [True])
+        self.assertEqual(json.loads(app.test_client().get('/categories/7').data)['category']['type'], 'Music')
+
     #  Get category questions
     #  ----------------------------------------------------------------
 
@@ -671,7 +1236,7 @@ class TriviaTestCase(unittest.TestCase):
         category_schema = Schema({
             'id': int,
             'type': str,
-            'questions': [int],
+            'total_questions': int,
         })
 
         question_schema = Schema({
@@ -679,9 +1244,12 @@ class TriviaTestCase(unittest.TestCase):
             'question': str,
             'answer': str,
             'difficulty': int,
-            'category': int
+            'category': int,
+            'version': int
         })
 
+        expected_questions = [question.format() for question in self.temp_categories[0].questions]
+
         res = self.client().get('/categories/1/questions')
 
         status = res.status_code
@@ -707,7 +1275,25 @@ class TriviaTestCase(unittest.TestCase):
         for i in range(len(questions)):
             question = questions[i]
             self.assertTrue(question_schema.is_valid(question))
-            self.assertEqual(question, self.temp_categories[0].questions[i].format())
+            self.assertEqual(question, expected_questions[i])
+
+    def test_get_category_questions_paginated_success(self):
+        for category_id in [1, 4]:
+            self.client().post('/questions', json={
+                'question': 'Who are you?',
+                'answer': 'Someone',
+                'difficulty': 5,
+                'category': category_id
+            })
+
+        data = json.loads(self.client().get('/categories/4/questions?page=1&per_page=2').data)
+        self.assertEqual([question['id'] for question in data['questions']], [1, 2])
+        self.assertEqual(data['total_questions'], 3)
+
+        data = json.loads(self.client().get(f"/categories/4/questions?cursor={data['next_cursor']}&per_page=2").data)
+        self.assertEqual([question['id'] for question in data['questions']], [7])
+        self.assertEqual(data['total_questions'], 3)
+        self.assertEqual(data['next_cursor'], None)
 
     def test_get_category_questions_fail_wrong_category(self):
         res = self.client().get('/categories/8/questions')
@@ -759,9 +1345,12 @@ class TriviaTestCase(unittest.TestCase):
             'question': str,
             'answer': str,
             'difficulty': int,
-            'category': int
+            'category': int,
+            'version': int
         })
 
+        expected_questions = [question.format() for question in self.temp_questions]
+
         res = self.client().post('/questions', json={
             'search_term': 'what'
         })
@@ -786,9 +1375,9 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(search_term, 'what')
         self.assertEqual(total_questions, 2)
         self.assertTrue(schema.is_valid(questions[0]))
-        self.assertEqual(questions[0], self.temp_questions[1].format())
+        self.assertEqual(questions[0], expected_questions[1])
         self.assertTrue(schema.is_valid(questions[1]))
-        self.assertEqual(questions[1], self.temp_questions[4].format())
+        self.assertEqual(questions[1], expected_questions[4])
 
     #  Search category questions
     #  ----------------------------------------------------------------
@@ -799,9 +1388,12 @@ class TriviaTestCase(unittest.TestCase):
             'question': str,
             'answer': str,
             'difficulty': int,
-            'category': int
+            'category': int,
+            'version': int
         })
 
+        expected_questions = [question.format() for question in self.temp_questions]
+
         res = self.client().post('/categories/4/questions', json={
             'search_term': 'what'
         })
@@ -826,7 +1418,124 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(search_term, 'what')
         self.assertEqual(total_questions, 1)
         self.assertTrue(schema.is_valid(questions[0]))
-        self.assertEqual(questions[0], self.temp_questions[1].format())
+        self.assertEqual(questions[0], expected_questions[1])
+
+    def test_search_category_question_regex_success(self):
+        res = self.client().post('/categories/4/questions', json={
+            'search_term': '^wh(o|at)',
+            'regex': True
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], 2)
+        self.assertEqual([question['id'] for question in data['questions']], [1, 2])
+
+    def test_search_category_question_literal(self):
+        res = self.client().post('/categories/4/questions', json={
+            'search_term': '.*'
+        })
+
+        # check the search term is not used as a pattern
+        self.assertEqual(res.status_code, 404)
+
+    def test_search_category_question_fail_bad_regex(self):
+        res = self.client().post('/categories/4/questions', json={
+            'search_term': 'wh(',
+            'regex': True
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['error'], 400)
+        self.assertEqual(data['description'], 'regex is not valid')
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_search_category_question_fail_backtracking_regex(self):
+        for (search_term, description) in [
+            ('(a+)+$', 'regex must not repeat a group holding quantifiers or alternatives'),
+            ('(w|wh)*o', 'regex must not repeat a group holding quantifiers or alternatives'),
+            ('(?:a?){20}', 'regex must not repeat a group holding quantifiers or alternatives'),
+            ('.*' * 14 + 'x', 'regex must not have more than one unbounded quantifier'),
+            ('w.+o.*x', 'regex must not have more than one unbounded quantifier'),
+            ('.{0,20}' * 3 + 'x', 'regex quantifiers and alternatives must not match in more than 1000 ways'),
+            ('a?' * 10, 'regex quantifiers and alternatives must not match in more than 1000 ways')
+        ]:
+            res = self.client().post('/categories/4/questions', json={
+                'search_term': search_term,
+                'regex': True
+            })
+
+            # check the pattern is rejected before it runs
+            self.assertEqual(res.status_code, 400, search_term)
+            self.assertEqual(json.loads(res.data)['description'], description)
+
+    def test_search_category_question_fail_regex_steps(self):
+        db.session.add(Question('Who ' + 'a' * 5000 + '?', 'Someone', 1, 4))
+        db.session.commit()
+
+        res = self.client().post('/categories/4/questions', json={
+            'search_term': 'w.*z',
+            'regex': True
+        })
+
+        # check a question the pattern could backtrack too long on isn't matched
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(json.loads(res.data)['description'],
+                         'regex search takes longer than 1000 ms or backtracks too much on a question')
+
+        res = self.client().post('/categories/4/questions', json={
+            'search_term': 'who a',
+            'regex': True
+        })
+
+        # check patterns without an unbounded quantifier still match it
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['total_questions'], 1)
+
+    def test_search_category_question_fail_regex_timeout(self):
+        write_questions(db.session, generate_questions(3000, {4: 1}), 1000)
+
+        app = create_app({'TESTING': True, 'SEARCH_REGEX_TIMEOUT': 1e-6})
+        setup_db(app, 'trivia_test')
+        client = app.test_client()
+
+        res = client.post('/categories/4/questions', json={
+            'search_term': 'w.*z',
+            'regex': True
+        })
+
+        # check the search is interrupted
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(json.loads(res.data)['description'], 'regex search takes longer than 1e-06 ms or backtracks too much on a question')
+
+        # check the connection isn't left interrupting later statements
+        res = client.get('/categories/4/questions')
+        self.assertEqual(res.status_code, 200)
+
+    def test_search_category_question_fail_bad_search_term(self):
+        for regex in [False, True]:
+            for search_term in [5, ['what'], None]:
+                res = self.client().post('/categories/4/questions', json={
+                    'search_term': search_term,
+                    'regex': regex
+                })
+
+                status = res.status_code
+                data = json.loads(res.data)
+
+                # check status and data
+                self.assertEqual(status, 400, search_term)
+                self.assertFalse(data['success'])
+                self.assertEqual(data['description'], 'search term must be a string')
 
     def test_search_category_question_fail_bad_input(self):
         res = self.client().post('/categories/1/questions', json={
@@ -904,7 +1613,8 @@ class TriviaTestCase(unittest.TestCase):
             'question': str,
             'answer': str,
             'difficulty': int,
-            'category': int
+            'category': int,
+            'version': int
         })
 
         res = self.client().post('/quizzes', json={
@@ -936,7 +1646,8 @@ class TriviaTestCase(unittest.TestCase):
             'question': str,
             'answer': str,
             'difficulty': int,
-            'category': int
+            'category': int,
+            'version': int
         })
 
         res = self.client().post('/quizzes', json={
@@ -963,6 +1674,50 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(question, self.temp_questions[0].format())
         self.assertEqual(total_questions, 1)
 
+    def test_quizzes_random_modes_success(self):
+        for mode in ['range', 'order']:
+            app = create_app({'TESTING': True, 'QUIZ_RANDOM_MODE': mode})
+            setup_db(app, 'trivia_test')
+
+            for previous_questions in [[1, 3, 4, 5], [2, 3, 4, 5], [1, 2, 3, 4]]:
+                res = app.test_client().post('/quizzes', json={
+                    'previous_questions': previous_questions
+                })
+
+                status = res.status_code
+                data = json.loads(res.data)
+
+                # check the only unseen question is returned
+                self.assertEqual(status, 200)
+                self.assertEqual(data['total_questions'], 1)
+                self.assertEqual(data['question']['id'], ({1, 2, 3, 4, 5} - set(previous_questions)).pop())
+
+            for previous_questions in [[1], [2]]:
+                res = app.test_client().post('/quizzes', json={
+                    'previous_questions': previous_questions,
+                    'quiz_category': 4
+                })
+
+                # check the other question of the category is returned
+                data = json.loads(res.data)
+                self.assertEqual(data['total_questions'], 1)
+                self.assertEqual(data['question']['id'], ({1, 2} - set(previous_questions)).pop())
+
+    def test_quizzes_all_seen(self):
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [1, 2],
+            'quiz_category': 4
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], 0)
+        self.assertFalse('question' in data)
+
     def test_quizzes_fail_bad_input(self):
         res = self.client().post('/quizzes', json={
             'quiz_category': 'dsad'
@@ -986,6 +1741,37 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(description, 'quiz input was bad or not formatted correctly')
         self.assertEqual(message, 'bad request')
 
+    def test_quizzes_fail_no_previous_question(self):
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [2, 6]
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['error'], 400)
+        self.assertEqual(data['description'], 'quiz input was bad or not formatted correctly')
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_quizzes_fail_wrong_category(self):
+        res = self.client().post('/quizzes', json={
+            'previous_questions': [2, 3],
+            'quiz_category': 4
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['error'], 400)
+        self.assertEqual(data['description'], 'a question does not belong to category')
+        self.assertEqual(data['message'], 'bad request')
+
     def test_quizzes_fail_no_body(self):
         res = self.client().post('/quizzes')
 
@@ -1007,6 +1793,661 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(description, 'no json body was found')
         self.assertEqual(message, 'bad request')
 
+    #  Quiz sessions
+    #  ----------------------------------------------------------------
+
+    def test_quiz_session_category_success(self):
+        expected_questions = [self.temp_questions[0].format(), self.temp_questions[1].format()]
+
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': 4
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 200)
+        self.assertTrue('success' in data)
+        self.assertTrue('session' in data)
+        self.assertTrue('total_questions' in data)
+
+        # check success
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_questions'], 2)
+        self.assertEqual(data['category'], 4)
+
+        # check every question of the category is dealt exactly once
+        session = data['session']
+        questions = []
+        for total_questions in [2, 1]:
+            data = json.loads(self.client().post(f'/quizzes/sessions/{session}').data)
+            self.assertEqual(data['total_questions'], total_questions)
+            questions.append(data['question'])
+
+        self.assertEqual(sorted(questions, key=lambda question: question['id']), expected_questions)
+
+        data = json.loads(self.client().post(f'/quizzes/sessions/{session}').data)
+        self.assertEqual(data['total_questions'], 0)
+        self.assertFalse('question' in data)
+
+    def test_quiz_session_skips_deleted_questions(self):
+        session = json.loads(self.client().post('/quizzes/sessions', json={}).data)['session']
+
+        self.client().delete('/questions/1')
+
+        questions = []
+        data = json.loads(self.client().post(f'/quizzes/sessions/{session}').data)
+        while 'question' in data:
+            questions.append(data['question']['id'])
+            data = json.loads(self.client().post(f'/quizzes/sessions/{session}').data)
+
+        self.assertEqual(sorted(questions), [2, 3, 4, 5])
+
+    def test_quiz_session_deck_size(self):
+        app = create_app({'TESTING': True, 'QUIZ_SESSION_DECK_SIZE': 3})
+        setup_db(app, 'trivia_test')
+
+        data = json.loads(app.test_client().post('/quizzes/sessions', json={}).data)
+        self.assertEqual(data['total_questions'], 3)
+
+        # check the deck holds 3 distinct questions
+        session = data['session']
+        questions = []
+        data = json.loads(app.test_client().post(f'/quizzes/sessions/{session}').data)
+        while 'question' in data:
+            questions.append(data['question']['id'])
+            data = json.loads(app.test_client().post(f'/quizzes/sessions/{session}').data)
+
+        self.assertEqual(len(set(questions)), 3)
+        self.assertTrue(set(questions) <= {1, 2, 3, 4, 5})
+
+    def test_quiz_session_skips_deleted_questions_in_one_query(self):
+        session = json.loads(self.client().post('/quizzes/sessions', json={}).data)['session']
+
+        for question_id in [1, 2, 3, 4]:
+            self.client().delete(f'/questions/{question_id}')
+
+        (res, statements) = self.count_statements('post', f'/quizzes/sessions/{session}')
+        data = json.loads(res.data)
+
+        # check the only remaining question is dealt with a single lookup
+        self.assertEqual(data['question']['id'], 5)
+        self.assertEqual(statements, 1)
+
+    def test_quiz_session_fail_bad_input(self):
+        res = self.client().post('/quizzes/sessions', json={
+            'quiz_category': 8
+        })
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['error'], 400)
+        self.assertEqual(data['description'], 'quiz session input was bad or not formatted correctly')
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_quiz_session_fail_no_session(self):
+        res = self.client().post('/quizzes/sessions/sadsadsad')
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 404)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['error'], 404)
+        self.assertEqual(data['description'], 'no quiz session found with id sadsadsad')
+        self.assertEqual(data['message'], 'not found')
+
+    def test_quiz_session_delete(self):
+        session = json.loads(self.client().post('/quizzes/sessions', json={}).data)['session']
+
+        res = self.client().delete(f'/quizzes/sessions/{session}')
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().post(f'/quizzes/sessions/{session}')
+        self.assertEqual(res.status_code, 404)
+
+    #----------------------------------------------------------------------------#
+    # Conditional Requests.
+    #----------------------------------------------------------------------------#
+
+    def test_conditional_get_not_modified(self):
+        for url in ['/questions', '/questions/1', '/categories', '/categories/1', '/categories/1/questions']:
+            res = self.client().get(url)
+            etag = res.headers.get('ETag')
+
+            # check etag
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(etag)
+
+            res = self.client().get(url, headers={'If-None-Match': etag})
+
+            # check not modified
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(res.headers.get('ETag'), etag)
+            self.assertEqual(res.data, b'')
+
+    def test_conditional_get_modified(self):
+        etag = self.client().get('/categories').headers.get('ETag')
+
+        self.client().post('/questions', json={
+            'question': 'Who are you?',
+            'answer': 'Someone',
+            'difficulty': 5,
+            'category': 1
+        })
+
+        res = self.client().get('/categories', headers={'If-None-Match': etag})
+
+        # check the write changed the etag
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers.get('ETag'), etag)
+
+    def test_conditional_get_modified_by_edit_and_delete(self):
+        etag = self.client().get('/questions/2').headers.get('ETag')
+
+        self.client().patch('/questions/2', json={
+            'answer': 'Someone'
+        })
+
+        # check the edit changed the etag
+        res = self.client().get('/questions/2', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers.get('ETag'), etag)
+
+        etag = self.client().get('/questions').headers.get('ETag')
+        self.client().delete('/questions/2')
+
+        # check the delete changed the etag
+        res = self.client().get('/questions', headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers.get('ETag'), etag)
+
+    def test_question_etag_is_its_version(self):
+        res = self.client().get('/questions/1')
+        etag = res.headers.get('ETag')
+
+        # check the etag is the question version
+        self.assertEqual(etag, '"1"')
+
+        res = self.client().patch('/questions/1', headers={'If-Match': etag}, json={
+            'answer': 'Someone'
+        })
+
+        # check the etag of the get is accepted by If-Match and the edit sends the new one
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers.get('ETag'), '"2"')
+
+        res = self.client().put('/questions/1', headers={'If-Match': res.headers.get('ETag')}, json={
+            'question': 'Who are you?',
+            'answer': 'Someone',
+            'difficulty': 5,
+            'category': 1
+        })
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers.get('ETag'), '"3"')
+
+        # check a stale etag conflicts
+        res = self.client().patch('/questions/1', headers={'If-Match': etag}, json={
+            'answer': 'Someone else'
+        })
+        self.assertEqual(res.status_code, 409)
+
+    #----------------------------------------------------------------------------#
+    # Health.
+    #----------------------------------------------------------------------------#
+    def test_health_success(self):
+        self.client().get('/questions')
+        res = self.client().get('/health')
+
+        status = res.status_code
+        data = json.loads(res.data)
+
+        # check status and data
+        self.assertEqual(status, 200)
+        self.assertTrue('success' in data)
+        self.assertTrue('database' in data)
+        self.assertTrue('pool' in data)
+
+        # check success
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['database'], 'ok')
+
+        # check pool stats
+        pool = data['pool']
+        self.assertEqual(pool['class'], 'MeasuredQueuePool')
+        self.assertEqual(pool['size'], 5)
+        self.assertEqual(pool['checked_out'], 0)
+        self.assertEqual(pool['overflow'], 0)
+        self.assertTrue(pool['checkouts'] >= 2)
+        self.assertEqual(pool['timeouts'], 0)
+
+    def test_health_pool_config(self):
+        app = create_app({'TESTING': True, 'DATABASE_POOL_SIZE': 2, 'DATABASE_MAX_OVERFLOW': 1, 'DATABASE_POOL_TIMEOUT': 5})
+        setup_db(app, 'trivia_test')
+
+        pool = json.loads(app.test_client().get('/health').data)['pool']
+        self.assertEqual(pool['size'], 2)
+        self.assertEqual(pool['max_overflow'], 1)
+        self.assertEqual(pool['timeout'], 5)
+
+    #----------------------------------------------------------------------------#
+    # Generate Questions.
+    #----------------------------------------------------------------------------#
+    def test_generate_questions_success(self):
+        result = self.app.test_cli_runner().invoke(args=['generate-questions', '100', '--seed', '1'])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        # check generated questions and counts
+        data = json.loads(self.client().get('/questions?page=1').data)
+        self.assertEqual(data['total_questions'], 105)
+        data = json.loads(self.client().get('/categories').data)
+        self.assertEqual(sum(category['total_questions'] for category in data['categories']), 105)
+
+    def test_generate_questions_deterministic(self):
+        generated = []
+        for _ in range(2):
+            result = self.app.test_cli_runner().invoke(args=['generate-questions', '20', '--seed', '7', '--categories', '2=1'])
+            self.assertEqual(result.exit_code, 0, result.output)
+
+            data = json.loads(self.client().get('/categories/2/questions').data)
+            generated.append([(question['question'], question['answer'], question['difficulty']) for question in data['questions'][-20:]])
+
+        # check the same seed generated the same questions in category 2
+        self.assertEqual(generated[0], generated[1])
+        self.assertEqual(json.loads(self.client().get('/categories/2').data)['category']['total_questions'], 41)
+
+    def test_generate_questions_fail_bad_weights(self):
+        for args in [['--categories', '9=1'], ['--categories', '1=x'], ['--difficulties', '6=1']]:
+            result = self.app.test_cli_runner().invoke(args=['generate-questions', '10', *args])
+            self.assertNotEqual(result.exit_code, 0, args)
+
+        # check nothing was generated
+        self.assertEqual(json.loads(self.client().get('/questions?page=1').data)['total_questions'], 5)
+
+    #----------------------------------------------------------------------------#
+    # Metrics.
+    #----------------------------------------------------------------------------#
+    def test_metrics_success(self):
+        self.client().get('/questions?page=1')
+        self.client().get('/questions/6')
+
+        res = self.client().get('/metrics')
+
+        # check status and format
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/plain')
+        lines = res.data.decode().splitlines()
+        self.assertTrue('# TYPE trivia_http_request_duration_seconds histogram' in lines)
+
+        # check request and error counts
+        self.assertTrue('trivia_http_requests_total{method="GET",route="/questions",status="200"} 1' in lines)
+        self.assertTrue('trivia_http_requests_total{method="GET",route="/questions/<int:question_id>",status="404"} 1' in lines)
+        self.assertTrue('trivia_http_request_errors_total{method="GET",route="/questions/<int:question_id>",status="404"} 1' in lines)
+
+        # check histograms
+        self.assertTrue('trivia_http_request_duration_seconds_bucket{method="GET",route="/questions",le="+Inf"} 1' in lines)
+        self.assertTrue('trivia_http_response_size_bytes_count{method="GET",route="/questions"} 1' in lines)
+        self.assertTrue('trivia_http_request_sql_statements_bucket{method="GET",route="/questions",le="0"} 0' in lines)
+        self.assertTrue('trivia_http_request_sql_statements_count{method="GET",route="/questions"} 1' in lines)
+
+    def test_metrics_disabled(self):
+        app = create_app({'TESTING': True, 'METRICS_ENABLED': False})
+        setup_db(app, 'trivia_test')
+
+        app.test_client().get('/questions')
+        res = app.test_client().get('/metrics')
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(json.loads(res.data)['description'], 'metrics are disabled')
+
+    #----------------------------------------------------------------------------#
+    # Read Replicas.
+    #----------------------------------------------------------------------------#
+    def create_replica_app(self, replica_urls):
+        app = create_app({'TESTING': True, 'DATABASE_REPLICA_URLS': replica_urls})
+        setup_db(app, 'trivia_test')
+        return app
+
+    def replica_reads(self, app):
+        return [replica['reads'] for replica in json.loads(app.test_client().get('/health').data)['replicas']]
+
+    def test_read_replicas_round_robin(self):
+        app = self.create_replica_app([database_path('trivia_test'), database_path('trivia_test')])
+
+        data = json.loads(app.test_client().get('/questions?page=1').data)
+        self.assertEqual(data['total_questions'], 5)
+        data = json.loads(app.test_client().post('/quizzes', json={
+            'previous_questions': [],
+            'quiz_category': 4
+        }).data)
+        self.assertEqual(data['total_questions'], 2)
+
+        # check each replica served one request
+        self.assertEqual(self.replica_reads(app), [1, 1])
+
+    def test_read_replicas_fallback(self):
+        app = self.create_replica_app(['sqlite:////nonexistent/trivia_test.db', database_path('trivia_test')])
+
+        # check the read the unavailable replica failed is answered by the primary
+        res = app.test_client().get('/categories')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.replica_reads(app), [0, 0])
+
+        res = app.test_client().get('/categories')
+        self.assertEqual(res.status_code, 200)
+
+        # check the unavailable replica was skipped
+        replicas = json.loads(app.test_client().get('/health').data)['replicas']
+        self.assertEqual([replica['available'] for replica in replicas], [False, True])
+        self.assertEqual([replica['reads'] for replica in replicas], [0, 1])
+
+        # check the primary answers when no replica does
+        app = self.create_replica_app(['sqlite:////nonexistent/trivia_test.db'])
+        res = app.test_client().get('/questions/1')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.replica_reads(app), [0])
+
+    def test_read_replicas_fail_after_pick(self):
+        app = self.create_replica_app([database_path('trivia_test')])
+        self.assertEqual(app.test_client().get('/questions/1').status_code, 200)
+        self.assertEqual(self.replica_reads(app), [1])
+
+        # the replica goes away while its pool holds a connection
+        def replica_went_away(conn, cursor, statement, parameters, context, executemany):
+            raise OperationalError(statement, parameters, Exception('server closed the connection unexpectedly'))
+
+        event.listen(app.extensions['replicas'].engines[0], 'before_cursor_execute', replica_went_away)
+
+        # check the read is run again on the primary and the replica marked down
+        for _ in range(2):
+            res = app.test_client().get('/questions/1')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(json.loads(res.data)['question']['id'], 1)
+
+        replicas = json.loads(app.test_client().get('/health').data)['replicas']
+        self.assertEqual([replica['available'] for replica in replicas], [False])
+        self.assertEqual([replica['reads'] for replica in replicas], [1])
+
+    def test_read_replicas_skip_writes(self):
+        app = self.create_replica_app([database_path('trivia_test')])
+
+        res = app.test_client().patch('/questions/1', json={
+            'answer': 'Someone'
+        })
+        self.assertEqual(res.status_code, 200)
+
+        res = app.test_client().get('/questions/1', headers={'X-Read-Your-Writes': 'true'})
+        self.assertEqual(json.loads(res.data)['question']['answer'], 'Someone')
+
+        # check neither request used the replica
+        self.assertEqual(self.replica_reads(app), [0])
+
+    #----------------------------------------------------------------------------#
+    # JSON Responses.
+    #----------------------------------------------------------------------------#
+    def create_json_app(self, **config):
+        app = create_app({'TESTING': True, **config})
+        setup_db(app, 'trivia_test')
+        return app
+
+    def test_json_providers_match(self):
+        urls = ['/questions', '/questions?page=1', '/categories', '/categories/4/questions', '/questions/404']
+        stdlib_client = self.create_json_app(JSON_PROVIDER='stdlib').test_client()
+
+        # check the default provider (orjson when installed) answers the same bytes
+        for url in urls:
+            self.assertEqual(self.client().get(url).data, stdlib_client.get(url).data, url)
+
+    def test_json_streamed_questions(self):
+        expected = self.client().get('/questions').data
+        app = self.create_json_app(JSON_STREAM_THRESHOLD=2, JSON_STREAM_CHUNK_SIZE=2)
+
+        for provider in ('auto', 'stdlib'):
+            app.extensions['json_provider'] = json_provider(provider)
+
+            res = app.test_client().get('/questions')
+            self.assertEqual(res.status_code, 200)
+            self.assertFalse('Content-Length' in res.headers)
+            self.assertEqual(res.content_type, 'application/json')
+            self.assertEqual(res.data, expected)
+
+            # check pages under the threshold aren't streamed
+            res = app.test_client().get('/questions?page=1&per_page=2')
+            self.assertTrue('Content-Length' in res.headers)
+
+    def test_json_provider_invalid(self):
+        with self.assertRaises(ValueError):
+            create_app({'TESTING': True, 'JSON_PROVIDER': 'yaml'})
+
+    #----------------------------------------------------------------------------#
+    # Query Budgets.
+    #----------------------------------------------------------------------------#
+    def count_statements(self, method, url, **kwargs):
+        with self.client() as client:
+            res = getattr(client, method)(url, **kwargs)
+            return (res, g.sql_statements - g.get('registry_statements', 0))
+
+    def test_query_budgets_cover_every_route(self):
+        for rule in self.app.url_map.iter_rules():
+            if rule.endpoint != 'static':
+                self.assertTrue(hasattr(self.app.view_functions[rule.endpoint], 'query_budget'), rule.endpoint)
+
+    def test_query_budgets_of_read_routes(self):
+        session = json.loads(self.client().post('/quizzes/sessions', json={}).data)['session']
+
+        for (method, url, kwargs, budget) in [
+            ('get', '/questions?page=1', {}, 3),
+            ('get', '/questions/export', {}, 2),
+            ('get', '/questions/1', {}, 2),
+            ('post', '/questions', {'json': {'search_term': 'who'}}, 4),
+            ('post', '/quizzes', {'json': {'previous_questions': [1], 'quiz_category': 4}}, 5),
+            ('post', '/quizzes/sessions', {'json': {'quiz_category': 4}}, 1),
+            ('post', f'/quizzes/sessions/{session}', {}, 2),
+            ('delete', f'/quizzes/sessions/{session}', {}, 0),
+            ('get', '/categories?include=question_ids', {}, 3),
+            ('get', '/categories/4', {}, 2),
+            ('get', '/categories/4/questions?page=1', {}, 3),
+            ('post', '/categories/4/questions', {'json': {'search_term': 'what'}}, 4),
+            ('post', '/categories/4/questions?page=1', {'json': {'search_term': 'what'}}, 4),
+            ('post', '/categories/4/questions?after_id=1', {'json': {'search_term': 'what'}}, 4),
+            ('post', '/categories/4/questions?page=1&exact_count=true', {'json': {'search_term': 'what'}}, 4),
+            ('post', '/categories/4/questions?page=1', {'json': {'search_term': 'w.at', 'regex': True}}, 4),
+            ('get', '/health', {}, 1),
+            ('get', '/metrics', {}, 0)
+        ]:
+            (res, statements) = self.count_statements(method, url, **kwargs)
+
+            # check the request succeeded within its budget
+            self.assertEqual(res.status_code, 200, url)
+            self.assertLessEqual(statements, budget, url)
+
+    def test_query_budgets_of_quiz_modes(self):
+        for mode in ['range', 'order']:
+            app = create_app({'TESTING': True, 'QUIZ_RANDOM_MODE': mode})
+            setup_db(app, 'trivia_test')
+
+            for body in [
+                {'previous_questions': []},
+                {'previous_questions': [1, 3]},
+                {'previous_questions': [], 'quiz_category': 4},
+                {'previous_questions': [1], 'quiz_category': 4},
+                {'previous_questions': [2], 'quiz_category': 4}
+            ]:
+                with app.test_client() as client:
+                    res = client.post('/quizzes', json=body)
+                    statements = g.sql_statements - g.get('registry_statements', 0)
+
+                # check the request succeeded within its budget
+                self.assertEqual(res.status_code, 200, body)
+                self.assertLessEqual(statements, 5, (mode, body))
+
+    def test_query_budgets_of_write_routes(self):
+        for (method, url, kwargs, budget) in [
+            ('post', '/questions', {'json': {'question': 'Who are you?', 'answer': 'Someone', 'difficulty': 5, 'category': 1}}, 4),
+            ('post', '/questions/bulk', {
+                'data': '{"question": "Who are you?", "answer": "Someone", "difficulty": 5, "category": 1}\n',
+                'content_type': 'application/x-ndjson'
+            }, 4),
+            ('put', '/questions/1', {'json': {'question': 'Who are you?', 'answer': 'Someone', 'difficulty': 5, 'category': 1}}, 6),
+            ('patch', '/questions/2', {'json': {'category': 1}}, 6),
+            ('delete', '/questions/3', {}, 4),
+            ('patch', '/questions/bulk', {'json': {'filter': {'category': 1}, 'values': {'category': 2}}}, 5),
+            ('delete', '/questions/bulk', {'json': {'filter': {'category': 2}}}, 4),
+            # bulk writes across every category run as many statements
+            ('post', '/questions/bulk', {
+                'data': ''.join(f'{{"question": "Who are you?", "answer": "Someone", "difficulty": 5, "category": {category_id}}}\n'
+                                for category_id in range(1, 7)),
+                'content_type': 'application/x-ndjson'
+            }, 4),
+            ('patch', '/questions/bulk', {'json': {'filter': {'difficulty': 5}, 'values': {'category': 3}}}, 5),
+            ('delete', '/questions/bulk', {'json': {'filter': {'difficulty': 5}}}, 4)
+        ]:
+            (res, statements) = self.count_statements(method, url, **kwargs)
+
+            # check the request succeeded within its budget
+            self.assertEqual(res.status_code, 200, url)
+            self.assertLessEqual(statements, budget, url)
+
+    def test_query_budget_exceeded(self):
+        for testing in [True, False]:
+            app = create_app({'TESTING': testing})
+            setup_db(app, 'trivia_test')
+
+            @app.route('/questions/lazy')
+            @query_budget(1)
+            def get_questions_lazily():
+                return {'categories': [question.category.type for question in Question.query.all()]}
+
+            # check an N+1 view raises while testing and logs otherwise
+            if testing:
+                with self.assertRaises(QueryBudgetExceeded):
+                    app.test_client().get('/questions/lazy')
+            else:
+                with self.assertLogs(app.logger, 'WARNING'):
+                    self.assertEqual(app.test_client().get('/questions/lazy').status_code, 200)
+
+    #----------------------------------------------------------------------------#
+    # Query Plans.
+    #----------------------------------------------------------------------------#
+
+    # Hot requests of every route that reads or writes questions, none should
+    # need to read the whole questions table
+    PLANNED_REQUESTS = [
+        ('get', '/questions?after_id=1000', {}),
+        ('get', '/questions/100', {}),
+        ('get', '/questions/export?category=2&difficulty=3', {}),
+        ('post', '/questions?page=1', {'json': {'search_term': 'river'}}),
+        ('post', '/questions?page=1&order=rank', {'json': {'search_term': 'river'}}),
+        ('patch', '/questions/100', {'json': {'difficulty': 3}}),
+        ('put', '/questions/101', {'json': {'question': 'Who?', 'answer': 'Someone', 'difficulty': 1, 'category': 2}}),
+        ('delete', '/questions/102', {}),
+        ('patch', '/questions/bulk', {'json': {'ids': [200, 201], 'values': {'difficulty': 1}}}),
+        ('patch', '/questions/bulk', {'json': {'filter': {'category': 3, 'difficulty': 2}, 'values': {'answer': 'None'}}}),
+        ('delete', '/questions/bulk', {'json': {'ids': [202, 203]}}),
+        ('post', '/quizzes', {'json': {'previous_questions': [1, 2], 'quiz_category': 4}}),
+        ('post', '/quizzes/sessions', {'json': {'quiz_category': 4}}),
+        ('get', '/categories?include=question_ids', {}),
+        ('get', '/categories/4/questions?page=2', {}),
+        ('get', '/categories/4/questions?after_id=1000', {}),
+        ('post', '/categories/4/questions?page=1', {'json': {'search_term': 'river'}}),
+        ('post', '/categories/4/questions?page=1', {'json': {'search_term': 'ri.er', 'regex': True}})
+    ]
+
+    def seed_questions(self, count):
+        write_questions(db.session, generate_questions(count, {category_id: 1 for category_id in range(1, 7)}), 1000)
+        recount_questions()
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+
+    # Returns the statements (with their parameters) the requests ran
+    def record_statements(self, requests):
+        statements = []
+
+        def record_statement(conn, cursor, statement, parameters, context, executemany):
+            if not executemany:
+                statements.append((statement, parameters))
+
+        event.listen(db.engine, 'before_cursor_execute', record_statement)
+        try:
+            for (method, url, kwargs) in requests:
+                res = getattr(self.client(), method)(url, **kwargs)
+                self.assertTrue(res.status_code < 400, f'{method.upper()} {url} answered {res.status_code}')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record_statement)
+
+        return statements
+
+    # Returns the plan steps of a statement that read the whole questions table,
+    # sequential scans and index scans without an index condition, and on
+    # SQLite searches probing questions_fts once per row (by rowid). PostgreSQL
+    # plans with sequential scans disabled so the plan doesn't depend on the
+    # table size, one only shows up when no index can answer the statement.
+    def full_scans(self, connection, statement, parameters):
+        if connection.dialect.name == 'postgresql':
+            connection.exec_driver_sql('SET enable_seqscan = off')
+            try:
+                (plan,) = connection.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + statement, parameters).scalar()
+            finally:
+                # the connection goes back to the pool
+                connection.exec_driver_sql('RESET enable_seqscan')
+
+            scans = []
+            nodes = [plan['Plan']]
+            while nodes:
+                node = nodes.pop()
+                nodes += node.get('Plans', [])
+                if node.get('Relation Name') != 'questions':
+                    continue
+                if node['Node Type'] == 'Seq Scan' or (node['Node Type'] in ('Index Scan', 'Index Only Scan') and 'Index Cond' not in node):
+                    scans.append(f"{node['Node Type']} on questions")
+            return scans
+
+        plan = [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+        return [step for step in plan if re.match(r'SCAN (TABLE )?questions\b|SCAN questions_fts VIRTUAL TABLE INDEX \d+:=', step)]
+
+    def test_query_plans_use_indexes(self):
+        self.seed_questions(5000)
+        statements = self.record_statements(self.PLANNED_REQUESTS)
+
+        scans = []
+        with db.engine.connect() as connection:
+            for (statement, parameters) in statements:
+                if re.match(r'\s*(SELECT|UPDATE|DELETE|WITH)\b', statement, re.IGNORECASE):
+                    scans += [(statement, scan) for scan in self.full_scans(connection, statement, parameters)]
+
+        self.assertTrue(len(statements) > len(self.PLANNED_REQUESTS))
+        self.assertEqual(scans, [])
+
+    def test_query_plans_catch_full_scans(self):
+        self.seed_questions(1000)
+        statements = self.record_statements([('get', '/questions/export?difficulty=3', {})])
+
+        # check a filter no index starts with is reported
+        with db.engine.connect() as connection:
+            scans = [self.full_scans(connection, statement, parameters) for (statement, parameters) in statements]
+        self.assertTrue(any(scans))
+
+    def test_query_plans_catch_search_probes(self):
+        if db.engine.dialect.name != 'sqlite':
+            self.skipTest('questions_fts is the search index of SQLite')
+
+        # a category walked by its index (CROSS JOIN keeps the order), probing
+        # the search index once per question
+        statement = (
+            "SELECT questions.id FROM questions CROSS JOIN questions_fts ON questions_fts.rowid = questions.id "
+            "WHERE questions.category_id = 4 AND questions_fts.question MATCH '\"river\"*'"
+        )
+
+        # check the per row probes are reported
+        with db.engine.connect() as connection:
+            self.assertTrue(self.full_scans(connection, statement, ()))
+
     #----------------------------------------------------------------------------#
     # Error Handling.
     #----------------------------------------------------------------------------#